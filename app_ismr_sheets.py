@@ -1,10 +1,30 @@
 import streamlit as st
 import gspread
 from google.oauth2.service_account import Credentials
-from datetime import datetime
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
+from requests.adapters import HTTPAdapter
+import requests
+from streamlit.runtime.scriptrunner import ScriptRunContext, add_script_run_ctx
+from streamlit.runtime.state import SafeSessionState, SessionState
+import cProfile
 import hashlib
+import importlib.util
+import json
+import os
+import pstats
+import random
+import re
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
 import time
+import uuid
 
 st.set_page_config(page_title="Sistema ISMR", page_icon="📋", layout="centered")
 
@@ -58,6 +78,556 @@ def inyectar_css_selector():
     """, unsafe_allow_html=True)
 
 
+# ══════════════════════════════════════════════════════════════════════════════
+# PLANIFICADOR DE CUOTA DE LA API
+# ══════════════════════════════════════════════════════════════════════════════
+
+CUOTA_LECTURAS_MIN   = 60   # peticiones de lectura por minuto (limite de Google por usuario)
+CUOTA_ESCRITURAS_MIN = 60   # peticiones de escritura por minuto
+
+PRIORIDAD_REGISTRO = 0      # registro de casos, login y cuentas
+PRIORIDAD_BORRADOR = 1      # guardado/carga de borradores
+PRIORIDAD_PANEL    = 2      # lecturas del panel de visualizacion
+
+NOMBRES_PRIORIDAD = {PRIORIDAD_REGISTRO: "registro", PRIORIDAD_BORRADOR: "borrador", PRIORIDAD_PANEL: "panel"}
+
+# Fraccion del cubo que cada prioridad debe dejar libre para las superiores
+RESERVA_PRIORIDAD = {PRIORIDAD_REGISTRO: 0.0, PRIORIDAD_BORRADOR: 0.2, PRIORIDAD_PANEL: 0.5}
+
+METODOS_LECTURA = {
+    "get", "get_all_values", "get_all_records", "row_values", "col_values",
+    "batch_get", "values_get", "values_batch_get", "worksheet", "worksheets",
+    "open", "get_worksheet", "fetch_sheet_metadata",
+}
+
+class CuotaDiferida(Exception):
+    """La peticion no obtuvo turno sin esperar y quien llama puede servir datos viejos."""
+
+class _CuboTokens:
+    def __init__(self, por_minuto):
+        self.capacidad = float(por_minuto)
+        self.tokens    = float(por_minuto)
+        self.tasa      = por_minuto / 60.0
+        self.ultimo    = time.monotonic()
+
+    def recargar(self):
+        ahora = time.monotonic()
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.ultimo) * self.tasa)
+        self.ultimo = ahora
+
+    def espera_para(self, nivel):
+        return max((nivel - self.tokens) / self.tasa, 0.05)
+
+class _PlanificadorCuota:
+    """
+    Cubo de tokens compartido por todas las sesiones del proceso, uno para
+    lecturas y otro para escrituras.
+
+    Cada prioridad solo consume tokens por encima de su reserva, y una
+    peticion cede el turno mientras haya otras de mayor prioridad esperando;
+    asi el panel se queda sin cuota antes que un registro y antes de que
+    Google responda 429.
+    """
+
+    def __init__(self):
+        self.cubos     = {"lectura": _CuboTokens(CUOTA_LECTURAS_MIN),
+                          "escritura": _CuboTokens(CUOTA_ESCRITURAS_MIN)}
+        self.esperando = {"lectura": {p: 0 for p in RESERVA_PRIORIDAD},
+                          "escritura": {p: 0 for p in RESERVA_PRIORIDAD}}
+        self.diferidas = {p: 0 for p in RESERVA_PRIORIDAD}
+        self.cond      = threading.Condition()
+
+    def adquirir(self, tipo, prioridad, bloquear=True):
+        cubo, esperando = self.cubos[tipo], self.esperando[tipo]
+        nivel = RESERVA_PRIORIDAD[prioridad] * cubo.capacidad + 1
+        with self.cond:
+            esperando[prioridad] += 1
+            try:
+                while True:
+                    cubo.recargar()
+                    cede = any(esperando[p] for p in esperando if p < prioridad)
+                    if cubo.tokens >= nivel and not cede:
+                        cubo.tokens -= 1
+                        return True
+                    if not bloquear:
+                        self.diferidas[prioridad] += 1
+                        return False
+                    self.cond.wait(cubo.espera_para(nivel))
+            finally:
+                esperando[prioridad] -= 1
+                self.cond.notify_all()
+
+    def penalizar(self, tipo):
+        """Google respondio 429: vacia el cubo para frenar a todas las sesiones."""
+        with self.cond:
+            self.cubos[tipo].tokens = 0.0
+
+    def estado(self):
+        with self.cond:
+            for cubo in self.cubos.values():
+                cubo.recargar()
+            return {
+                tipo: {
+                    "tokens":    round(cubo.tokens, 1),
+                    "capacidad": int(cubo.capacidad),
+                    "en_cola":   {NOMBRES_PRIORIDAD[p]: n for p, n in self.esperando[tipo].items()},
+                }
+                for tipo, cubo in self.cubos.items()
+            } | {"diferidas": {NOMBRES_PRIORIDAD[p]: n for p, n in self.diferidas.items()}}
+
+@st.cache_resource
+def _planificador():
+    return _PlanificadorCuota()
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# E/S CON LA API: REINTENTOS Y CIRCUITO
+# ══════════════════════════════════════════════════════════════════════════════
+
+API_REINTENTOS       = 4      # reintentos despues del primer intento
+API_BACKOFF_BASE_SEG = 1.0
+API_BACKOFF_MAX_SEG  = 32.0
+CIRCUITO_FALLOS      = 5      # fallos transitorios seguidos que abren el circuito
+CIRCUITO_ABIERTO_SEG = 30     # tiempo rechazando llamadas antes de dejar pasar una de prueba
+
+ESTADOS_TRANSITORIOS = {408, 500, 502, 503, 504}
+
+# Tras un fallo ambiguo (5xx, corte de red) no se sabe si Google los aplico y
+# repetirlos podria duplicar filas: solo se reintentan ante 429, que se
+# responde sin aplicar la peticion. Las escrituras de casos y hechos resuelven
+# lo ambiguo con su columna ID_Solicitud.
+METODOS_NO_IDEMPOTENTES = {
+    "append_row", "append_rows", "values_append", "insert_row", "insert_rows",
+    "delete_rows", "add_worksheet", "create",
+}
+
+class CircuitoAbierto(CuotaDiferida):
+    """La API viene fallando y el circuito rechaza la peticion sin enviarla."""
+
+def _clasificar_error(e):
+    """'cuota' (429), 'transitorio' (408, 5xx, red) o 'permanente', segun el estado HTTP."""
+    if isinstance(e, gspread.exceptions.APIError):
+        estado = getattr(e.response, "status_code", None)
+        if estado == 429:
+            return "cuota"
+        return "transitorio" if estado in ESTADOS_TRANSITORIOS else "permanente"
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                      ConnectionError, TimeoutError)):
+        return "transitorio"
+    # Errores propios que envuelven al de la API (p.ej. la reversion de un registro)
+    return _clasificar_error(e.__cause__) if e.__cause__ else "permanente"
+
+def _espera_reintento(intento):
+    """Backoff exponencial con jitter completo, para que las sesiones no reintenten a la par."""
+    return random.uniform(0, min(API_BACKOFF_MAX_SEG, API_BACKOFF_BASE_SEG * 2 ** intento))
+
+class _Circuito:
+    """
+    Cortacircuitos del proceso: tras CIRCUITO_FALLOS fallos transitorios
+    seguidos rechaza todas las llamadas durante CIRCUITO_ABIERTO_SEG, y luego
+    deja pasar una sola de prueba que lo cierra o lo vuelve a abrir. Asi una
+    caida de Google no acumula sesiones esperando reintentos.
+    """
+
+    def __init__(self):
+        self.fallos        = 0
+        self.abierto_hasta = 0.0
+        self.probando      = False
+        self.aperturas     = 0
+        self.lock          = threading.Lock()
+
+    def permitir(self):
+        with self.lock:
+            if self.fallos < CIRCUITO_FALLOS:
+                return True
+            if self.probando or time.monotonic() < self.abierto_hasta:
+                return False
+            self.probando = True
+            return True
+
+    def exito(self):
+        with self.lock:
+            self.fallos, self.probando = 0, False
+
+    def fallo(self):
+        with self.lock:
+            self.fallos  += 1
+            self.probando = False
+            if self.fallos >= CIRCUITO_FALLOS:
+                self.aperturas    += self.fallos == CIRCUITO_FALLOS
+                self.abierto_hasta = time.monotonic() + CIRCUITO_ABIERTO_SEG
+
+    def estado(self):
+        with self.lock:
+            if self.fallos < CIRCUITO_FALLOS:
+                return "cerrado"
+            return "semiabierto" if time.monotonic() >= self.abierto_hasta else "abierto"
+
+@st.cache_resource
+def _circuito():
+    return _Circuito()
+
+def _api(objeto, metodo, *args, prioridad=PRIORIDAD_REGISTRO, bloquear=True, **kwargs):
+    """
+    Punto unico por el que pasa toda llamada a gspread: espera turno en el
+    planificador de cuota y ejecuta objeto.metodo(*args, **kwargs).
+
+    Un 429 vacia el cubo y se reintenta; 408, 5xx y cortes de red se
+    reintentan solo en metodos idempotentes y cuentan para el circuito; el
+    resto se lanza de inmediato. Con bloquear=False no espera turno ni
+    reintenta: lanza CuotaDiferida para que quien llama sirva datos viejos.
+    """
+    tipo     = "lectura" if metodo in METODOS_LECTURA else "escritura"
+    circuito = _circuito()
+    metricas = _metricas_api()
+    etiqueta = (_funcion_llamadora(), getattr(objeto, "title", type(objeto).__name__), metodo, tipo)
+    for intento in range(API_REINTENTOS + 1):
+        if not _planificador().adquirir(tipo, prioridad, bloquear):
+            metricas.registrar(*etiqueta, "diferida")
+            raise CuotaDiferida(f"{metodo} diferido por cuota")
+        if not circuito.permitir():
+            metricas.registrar(*etiqueta, "circuito")
+            raise CircuitoAbierto(f"{metodo} rechazado: la API de Google viene fallando")
+        inicio = time.perf_counter()
+        try:
+            resultado = getattr(objeto, metodo)(*args, **kwargs)
+        except Exception as e:
+            clase = _clasificar_error(e)
+            metricas.registrar(*etiqueta, "429" if clase == "cuota" else clase,
+                               time.perf_counter() - inicio)
+            if clase == "transitorio":
+                circuito.fallo()
+            else:
+                circuito.exito()   # Google respondio: la API esta en pie
+            if clase == "cuota":
+                _planificador().penalizar(tipo)
+            reintentable = clase == "cuota" or (clase == "transitorio" and metodo not in METODOS_NO_IDEMPOTENTES)
+            if reintentable and not bloquear:
+                raise CuotaDiferida(f"{metodo} diferido: {e}") from e
+            if not reintentable or intento == API_REINTENTOS:
+                raise
+            time.sleep(_espera_reintento(intento))
+            continue
+        finally:
+            _anotar_llamada(metodo, time.perf_counter() - inicio)
+        metricas.registrar(*etiqueta, "ok", time.perf_counter() - inicio)
+        circuito.exito()
+        return resultado
+
+def mostrar_estado_cuota():
+    """Niveles de tokens y profundidad de cola del planificador (sidebar admin)."""
+    estado = _planificador().estado()
+    with st.sidebar.expander("📶 Cuota API"):
+        for tipo in ("lectura", "escritura"):
+            e = estado[tipo]
+            st.caption(f"**{tipo.capitalize()}:** {e['tokens']}/{e['capacidad']} tokens")
+            st.progress(min(e["tokens"] / e["capacidad"], 1.0))
+            st.caption("En cola: " + ", ".join(f"{p} {n}" for p, n in e["en_cola"].items()))
+        st.caption("Diferidas: " + ", ".join(f"{p} {n}" for p, n in estado["diferidas"].items()))
+        circuito = _circuito()
+        st.caption(f"Circuito: {circuito.estado()} · aperturas: {circuito.aperturas}")
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# TRAZA POR RECARGA
+# ══════════════════════════════════════════════════════════════════════════════
+
+# Solo el hilo del script tiene traza; las llamadas del worker de la cola no cuentan
+_TRAZA = threading.local()
+
+def _iniciar_traza():
+    _TRAZA.actual = {"inicio": time.perf_counter(), "llamadas": []}
+
+def _cerrar_traza():
+    traza = getattr(_TRAZA, "actual", None)
+    if traza is not None:
+        _metricas_api().cerrar_recarga(len(traza["llamadas"]))
+
+def _anotar_llamada(metodo, segundos):
+    traza = getattr(_TRAZA, "actual", None)
+    if traza is not None:
+        traza["llamadas"].append((metodo, segundos))
+
+def _anotar_memoria(nbytes):
+    """Registra memoria propia de la sesion (vistas filtradas) en esta recarga."""
+    traza = getattr(_TRAZA, "actual", None)
+    if traza is not None:
+        traza["memoria"] = traza.get("memoria", 0) + int(nbytes)
+        st.session_state["memoria_pico"] = max(st.session_state.get("memoria_pico", 0), traza["memoria"])
+
+def mostrar_traza_rerun():
+    """Desglose de tiempo de la recarga actual (solo administradores)."""
+    traza = getattr(_TRAZA, "actual", None)
+    if traza is None or not st.session_state.es_admin:
+        return
+    total_ms = (time.perf_counter() - traza["inicio"]) * 1000
+    api_ms   = sum(seg for _, seg in traza["llamadas"]) * 1000
+    por_metodo = {}
+    for metodo, seg in traza["llamadas"]:
+        n, acumulado = por_metodo.get(metodo, (0, 0.0))
+        por_metodo[metodo] = (n + 1, acumulado + seg * 1000)
+    with st.expander(f"⏱️ Esta recarga: {total_ms:.0f} ms · {len(traza['llamadas'])} llamada(s) a la API"):
+        st.caption(f"Render: {total_ms - api_ms:.0f} ms · API: {api_ms:.0f} ms")
+        for metodo, (n, ms) in sorted(por_metodo.items(), key=lambda x: -x[1][1]):
+            st.caption(f"• {metodo}: {n} llamada(s), {ms:.0f} ms")
+        if "memoria" in traza:
+            st.caption(f"Memoria de la sesion: {traza['memoria'] / 1024:.1f} KB en esta recarga · "
+                       f"pico {st.session_state.get('memoria_pico', 0) / 1024:.1f} KB")
+
+# ══════════════════════════════════════════════════════════════════════════════
+# MÉTRICAS DE LA API
+# ══════════════════════════════════════════════════════════════════════════════
+
+METRICAS_MUESTRAS = 5000   # latencias recientes para percentiles y llamadas del ultimo minuto
+METRICAS_RECARGAS = 500    # recargas recientes para llamadas por recarga
+
+class _MetricasApi:
+    """
+    Contadores de todo el proceso para cada intento de llamada a gspread,
+    por (funcion que llama, hoja, metodo, resultado), mas las latencias y las
+    llamadas por recarga mas recientes. Alimentan el panel de rendimiento y
+    la exportacion en formato Prometheus.
+    """
+
+    def __init__(self):
+        self.llamadas  = Counter()   # (funcion, hoja, metodo, resultado) -> n
+        self.segundos  = Counter()   # misma clave -> segundos acumulados
+        self.latencias = deque(maxlen=METRICAS_MUESTRAS)   # (instante, tipo, segundos)
+        self.recargas  = deque(maxlen=METRICAS_RECARGAS)   # llamadas de cada recarga
+        self.inicio    = time.time()
+        self.lock      = threading.Lock()
+
+    def registrar(self, funcion, hoja, metodo, tipo, resultado, segundos=None):
+        clave = (funcion, hoja, metodo, resultado)
+        with self.lock:
+            self.llamadas[clave] += 1
+            if segundos is not None:
+                self.segundos[clave] += segundos
+                self.latencias.append((time.time(), tipo, segundos))
+
+    def cerrar_recarga(self, llamadas):
+        with self.lock:
+            self.recargas.append(llamadas)
+
+    def resumen(self):
+        with self.lock:
+            latencias = np.array([s for _, _, s in self.latencias])
+            hace_un_minuto = time.time() - 60
+            ultimo_minuto = Counter(t for instante, t, _ in self.latencias if instante >= hace_un_minuto)
+            recargas  = np.array(self.recargas)
+            llamadas  = sum(self.llamadas.values())
+            por_resultado = Counter()
+            for (_, _, _, resultado), n in self.llamadas.items():
+                por_resultado[resultado] += n
+        percentiles = (dict(zip(("p50", "p95", "p99"), np.percentile(latencias, [50, 95, 99])))
+                       if latencias.size else {})
+        return {
+            "llamadas":       llamadas,
+            "por_resultado":  por_resultado,
+            "latencia":       percentiles,
+            "ultimo_minuto":  ultimo_minuto,
+            "por_recarga":    {"media": recargas.mean(), "p95": np.percentile(recargas, 95),
+                               "suma": int(recargas.sum()), "n": recargas.size} if recargas.size else None,
+            "desde":          datetime.fromtimestamp(self.inicio),
+        }
+
+    def tabla(self):
+        """Llamadas, errores y latencia media por (funcion, hoja, metodo)."""
+        with self.lock:
+            filas = [{"Función": f, "Hoja": h, "Método": m, "Resultado": r,
+                      "Llamadas": n, "Segundos": self.segundos[(f, h, m, r)]}
+                     for (f, h, m, r), n in self.llamadas.items()]
+        if not filas:
+            return pd.DataFrame()
+        df = pd.DataFrame(filas)
+        agrupado = df.groupby(["Función", "Hoja", "Método"]).agg(
+            Llamadas=("Llamadas", "sum"), Segundos=("Segundos", "sum"))
+        agrupado["Fallidas"] = (df[df["Resultado"] != "ok"]
+                                .groupby(["Función", "Hoja", "Método"])["Llamadas"].sum())
+        agrupado["429"] = (df[df["Resultado"] == "429"]
+                           .groupby(["Función", "Hoja", "Método"])["Llamadas"].sum())
+        agrupado["ms medio"] = (agrupado["Segundos"] * 1000 / agrupado["Llamadas"]).round(1)
+        return (agrupado.drop(columns="Segundos").fillna(0)
+                .astype({"Fallidas": int, "429": int})
+                .sort_values("Llamadas", ascending=False).reset_index())
+
+    def prometheus(self):
+        """Exposicion en formato de texto de Prometheus."""
+        resumen = self.resumen()
+        cuota   = _planificador().estado()
+        with self.lock:
+            llamadas = dict(self.llamadas)
+            segundos = dict(self.segundos)
+        etiquetas = lambda clave: ",".join(
+            f'{nombre}="{_escapar_etiqueta(valor)}"'
+            for nombre, valor in zip(("funcion", "hoja", "metodo", "resultado"), clave))
+        lineas = [
+            "# HELP ismr_api_llamadas_total Intentos de llamada a la API de Google Sheets.",
+            "# TYPE ismr_api_llamadas_total counter",
+            *(f"ismr_api_llamadas_total{{{etiquetas(c)}}} {n}" for c, n in sorted(llamadas.items())),
+            "# HELP ismr_api_segundos_total Tiempo acumulado en llamadas a la API.",
+            "# TYPE ismr_api_segundos_total counter",
+            *(f"ismr_api_segundos_total{{{etiquetas(c)}}} {s:.6f}" for c, s in sorted(segundos.items())),
+            "# HELP ismr_api_latencia_segundos Latencia de las llamadas recientes.",
+            "# TYPE ismr_api_latencia_segundos summary",
+            *(f'ismr_api_latencia_segundos{{quantile="{q}"}} {resumen["latencia"][p]:.6f}'
+              for q, p in (("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99")) if resumen["latencia"]),
+            "# HELP ismr_api_tokens_disponibles Tokens del planificador de cuota.",
+            "# TYPE ismr_api_tokens_disponibles gauge",
+            *(f'ismr_api_tokens_disponibles{{tipo="{t}"}} {cuota[t]["tokens"]}' for t in ("lectura", "escritura")),
+            "# HELP ismr_api_llamadas_ultimo_minuto Llamadas enviadas en los ultimos 60 segundos.",
+            "# TYPE ismr_api_llamadas_ultimo_minuto gauge",
+            *(f'ismr_api_llamadas_ultimo_minuto{{tipo="{t}"}} {resumen["ultimo_minuto"][t]}'
+              for t in ("lectura", "escritura")),
+            "# HELP ismr_api_circuito_abierto 1 si el circuito de la API esta abierto.",
+            "# TYPE ismr_api_circuito_abierto gauge",
+            f"ismr_api_circuito_abierto {int(_circuito().estado() != 'cerrado')}",
+        ]
+        recargas = resumen["por_recarga"]
+        if recargas:
+            lineas += [
+                "# HELP ismr_recarga_llamadas Llamadas a la API por recarga de Streamlit.",
+                "# TYPE ismr_recarga_llamadas summary",
+                f'ismr_recarga_llamadas{{quantile="0.95"}} {recargas["p95"]:.1f}',
+                f"ismr_recarga_llamadas_sum {recargas['suma']}",
+                f"ismr_recarga_llamadas_count {recargas['n']}",
+            ]
+        return "\n".join(lineas) + "\n"
+
+def _escapar_etiqueta(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+@st.cache_resource
+def _metricas_api():
+    return _MetricasApi()
+
+PREFIJO_HILOS   = "ismr-"
+HILO_SIN_NOMBRE = "(otro hilo)"
+
+def _funcion_llamadora():
+    """
+    Primera funcion publica de este modulo en la pila de la llamada (p.ej.
+    guardar_borrador o panel_visualizacion); en los hilos de fondo sin una,
+    el nombre del hilo si es uno de los propios ("ismr-...") y si no una
+    etiqueta fija, para que las etiquetas no crezcan con cada hilo nuevo.
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        codigo = frame.f_code
+        if (codigo.co_filename == __file__ and not codigo.co_name.startswith("_")
+                and getattr(frame.f_globals.get(codigo.co_name), "__code__", None) is codigo):
+            return codigo.co_name
+        frame = frame.f_back
+    nombre = threading.current_thread().name
+    return nombre if nombre.startswith(PREFIJO_HILOS) else HILO_SIN_NOMBRE
+
+# ══════════════════════════════════════════════════════════════════════════════
+# PERFILADO DE RECARGAS
+# ══════════════════════════════════════════════════════════════════════════════
+
+PERFILES_MAX          = 20       # ultimos perfiles guardados (todas las sesiones)
+PERFIL_PROFUNDIDAD    = 80       # corte de pilas muy profundas al colapsar
+PERFIL_MIN_SEG        = 0.0002   # ramas con menos tiempo no se expanden
+
+# Funciones de pagina que despacha main(); el perfil se etiqueta con la que mas tiempo tomo
+PAGINAS_PERFILADAS = (
+    "login_page", "pantalla_cambiar_password", "pantalla_selector",
+    "formulario_individual", "formulario_colectivo", "panel_visualizacion",
+    "panel_importacion", "panel_gestion_usuarios", "panel_rendimiento",
+)
+
+class _Perfilador:
+    """
+    Modo de perfilado que activa un administrador para todo el proceso:
+    mientras esta activo cada recarga de main() corre bajo cProfile midiendo
+    tiempo de CPU del hilo (las esperas de la API ya las cubren las metricas)
+    y el resultado se guarda en un buffer circular de PERFILES_MAX. Solo se
+    perfila una recarga a la vez; las que coinciden con otra corren sin
+    perfilar.
+    """
+
+    def __init__(self):
+        self.activo   = False
+        self.perfiles = deque(maxlen=PERFILES_MAX)
+        self.lock     = threading.Lock()
+
+    @contextmanager
+    def perfilar(self):
+        if not self.activo or not self.lock.acquire(blocking=False):
+            yield
+            return
+        perfil = cProfile.Profile(time.thread_time)
+        inicio = time.perf_counter()
+        try:
+            perfil.enable()
+            try:
+                yield
+            finally:
+                # Tambien las recargas cortadas por st.rerun() o st.stop()
+                perfil.disable()
+                self._guardar(perfil, time.perf_counter() - inicio)
+        finally:
+            self.lock.release()
+
+    def _guardar(self, perfil, segundos):
+        estadisticas = pstats.Stats(perfil).stats
+        paginas = {f[2]: v[3] for f, v in estadisticas.items()
+                   if f[0] == __file__ and f[2] in PAGINAS_PERFILADAS}
+        self.perfiles.append({
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "pagina":    max(paginas, key=paginas.get) if paginas else "main",
+            "usuario":   st.session_state.get("username") or "—",
+            "segundos":  segundos,
+            "cpu":       sum(v[2] for v in estadisticas.values()),
+            "pilas":     _pilas_colapsadas(estadisticas),
+        })
+
+@st.cache_resource
+def _perfilador():
+    return _Perfilador()
+
+def _nombre_marco(funcion):
+    archivo, linea, nombre = funcion
+    if archivo == "~":   # funciones en C: nombre == "<built-in method ...>"
+        return nombre.replace(";", ",")
+    return f"{nombre} ({os.path.basename(archivo)}:{linea})".replace(";", ",")
+
+def _pilas_colapsadas(estadisticas):
+    """
+    Pilas en formato colapsado ('a;b;c microsegundos', el de flamegraph.pl y
+    speedscope) a partir del grafo llamador -> llamado de cProfile. Como
+    cProfile no guarda pilas completas, el tiempo de cada funcion se reparte
+    entre las rutas que llegan a ella en proporcion a lo que aporta cada
+    llamador.
+    """
+    hijos = {}
+    for funcion, (_, _, _, _, llamadores) in estadisticas.items():
+        for llamador, (_, _, propio, acumulado) in llamadores.items():
+            hijos.setdefault(llamador, []).append((funcion, propio, acumulado))
+    pilas = Counter()
+
+    def recorrer(funcion, pila, en_pila, propio, acumulado):
+        pila  = pila + (_nombre_marco(funcion),)
+        clave = ";".join(pila)
+        pilas[clave] += propio
+        total = estadisticas[funcion][3]
+        if not total:
+            return
+        escala = acumulado / total
+        for hijo, propio_h, acumulado_h in hijos.get(funcion, ()):
+            if (hijo in en_pila or len(pila) >= PERFIL_PROFUNDIDAD
+                    or acumulado_h * escala < PERFIL_MIN_SEG):
+                # Recursion, pila demasiado profunda o rama minima: su tiempo
+                # queda en este marco para que el total cuadre
+                pilas[clave] += acumulado_h * escala
+            else:
+                recorrer(hijo, pila, en_pila | {hijo}, propio_h * escala, acumulado_h * escala)
+
+    for funcion, (_, _, propio, acumulado, llamadores) in estadisticas.items():
+        if not llamadores:
+            recorrer(funcion, (), {funcion}, propio, acumulado)
+    return "\n".join(f"{pila} {round(seg * 1e6)}" for pila, seg in pilas.items() if seg * 1e6 >= 1) + "\n"
+
 # ══════════════════════════════════════════════════════════════════════════════
 # GOOGLE SHEETS — USUARIOS
 # ══════════════════════════════════════════════════════════════════════════════
@@ -70,84 +640,224 @@ def _credenciales():
     ]
     return Credentials.from_service_account_info(credentials_dict, scopes=scopes), credentials_dict
 
-@st.cache_resource(ttl=300)
-def _get_spreadsheet():
-    creds, _ = _credenciales()
-    client = gspread.authorize(creds)
-    return client.open(st.secrets.get("sheet_name", "ISMR_Casos"))
-
-@st.cache_resource(ttl=300)
-def _get_client_usuarios():
+@st.cache_resource
+def _get_client():
+    """
+    Cliente gspread unico del proceso. Todas las hojas comparten su sesion
+    HTTP (conexiones keep-alive) y el refresco del token OAuth.
+    """
     creds, creds_dict = _credenciales()
     client = gspread.authorize(creds)
+    client.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
     return client, creds_dict
 
+@st.cache_resource
+def _get_spreadsheet():
+    client, _ = _get_client()
+    return _api(client, "open", st.secrets.get("sheet_name", "ISMR_Casos"))
+
+POOL_HOJAS_TTL_SEG = 600   # se releen los metadatos por si alguien borro o renombro una hoja
+
+DIMENSIONES_HOJAS = {
+    "Individual":        ("1000", "20"),
+    "Hechos_Individual": ("1000", "20"),
+    "Colectivo":         ("1000", "20"),
+    "Hechos_Colectivo":  ("1000", "20"),
+    "Borradores":        ("500", "10"),
+    "Reservas_ID":       ("1000", "6"),
+}
+
+class _PoolHojas:
+    """
+    Handles de Worksheet del spreadsheet principal cacheados por titulo. Se
+    obtienen todos con una sola lectura de metadatos; las hojas que falten
+    se crean con las dimensiones de DIMENSIONES_HOJAS.
+
+    Ningun lock se mantiene mientras _api espera turno: un refresco del panel
+    esperando su reserva de cuota no debe frenar a un registro. Solo la
+    creacion de una hoja se serializa, y por nombre.
+    """
+
+    def __init__(self):
+        self.hojas    = {}
+        self.cargado  = 0.0
+        self.creando  = {}   # nombre -> Lock de su creacion
+        self.creadas  = {}   # nombre -> (hoja, momento) de las creadas por este proceso
+        self.lock     = threading.Lock()
+
+    def obtener(self, nombre, prioridad=PRIORIDAD_REGISTRO):
+        with self.lock:
+            vigente = bool(self.hojas) and time.time() - self.cargado <= POOL_HOJAS_TTL_SEG
+            if vigente and nombre in self.hojas:
+                return self.hojas[nombre]
+        if not vigente:
+            inicio = time.time()
+            hojas  = {h.title: h for h in _api(_get_spreadsheet(), "worksheets", prioridad=prioridad)}
+            with self.lock:
+                # Una hoja creada mientras se leian los metadatos puede no venir en la lectura
+                hojas.update({n: h for n, (h, t) in self.creadas.items() if t >= inicio and n not in hojas})
+                self.hojas, self.cargado = hojas, time.time()
+            if nombre in hojas:
+                return hojas[nombre]
+        with self.lock:
+            creacion = self.creando.setdefault(nombre, threading.Lock())
+        with creacion:
+            with self.lock:
+                if nombre in self.hojas:   # otro hilo la creo mientras se esperaba
+                    return self.hojas[nombre]
+            filas, columnas = DIMENSIONES_HOJAS.get(nombre, ("1000", "20"))
+            hoja = _api(_get_spreadsheet(), "add_worksheet", title=nombre,
+                        rows=filas, cols=columnas, prioridad=prioridad)
+            with self.lock:
+                self.hojas[nombre]   = hoja
+                self.creadas[nombre] = (hoja, time.time())
+            return hoja
+
+    def invalidar(self):
+        with self.lock:
+            self.cargado = 0.0
+
+@st.cache_resource
+def _pool_hojas():
+    return _PoolHojas()
+
+def _hoja(nombre, prioridad=PRIORIDAD_REGISTRO):
+    """Handle cacheado de una hoja del spreadsheet principal."""
+    return _pool_hojas().obtener(nombre, prioridad)
+
+@st.cache_resource
+def _hoja_usuarios():
+    client, creds_dict = _get_client()
+    sheet_name = st.secrets.get("sheet_usuarios", "ISMR_Usuarios")
+    try:
+        spreadsheet = _api(client, "open", sheet_name)
+    except gspread.exceptions.SpreadsheetNotFound:
+        # Solo si de verdad no existe: un 429, un 5xx o el circuito abierto se
+        # propagan y no quedan en la cache como una hoja de usuarios vacia
+        spreadsheet = _api(client, "create", sheet_name)
+        _api(spreadsheet, "share", creds_dict["client_email"], perm_type='user', role='writer')
+    worksheet = _api(spreadsheet, "get_worksheet", 0)
+    if not _api(worksheet, "row_values", 1):
+        _api(worksheet, "append_row", ["username", "password_hash", "nombre_completo",
+                                       "es_admin", "debe_cambiar_password"])
+    return worksheet
+
 def conectar_sheet_usuarios():
     try:
-        client, creds_dict = _get_client_usuarios()
-        sheet_name = st.secrets.get("sheet_usuarios", "ISMR_Usuarios")
-        try:
-            spreadsheet = client.open(sheet_name)
-        except Exception:
-            spreadsheet = client.create(sheet_name)
-            spreadsheet.share(creds_dict["client_email"], perm_type='user', role='writer')
-        worksheet = spreadsheet.sheet1
-        if not worksheet.row_values(1):
-            worksheet.append_row(["username", "password_hash", "nombre_completo",
-                                   "es_admin", "debe_cambiar_password"])
-        return worksheet
+        return _hoja_usuarios()
     except Exception as e:
         st.error(f"Error al conectar sheet de usuarios: {e}")
         return None
 
+USUARIOS_TTL_SEG = 120
+
+class _DirectorioUsuarios:
+    """
+    Cache de la hoja de usuarios indexada por username, con el numero de fila
+    de cada uno para poder escribirle sin volver a buscarlo. Expira a los
+    USUARIOS_TTL_SEG y las escrituras propias la actualizan al momento.
+    """
+
+    def __init__(self):
+        self.usuarios = {}     # username -> (fila, registro)
+        self.cargado  = 0.0
+        self.lock     = threading.Lock()
+
+    def vigente(self):
+        return time.time() - self.cargado < USUARIOS_TTL_SEG
+
+    def cargar(self, ws):
+        datos = _api(ws, "get_all_values")
+        encabezados = datos[0] if datos else []
+        self.usuarios = {
+            fila[0]: (idx, dict(zip(encabezados, fila)))
+            for idx, fila in enumerate(datos[1:], start=2) if fila and fila[0]
+        }
+        self.cargado = time.time()
+
+    def invalidar(self):
+        self.cargado = 0.0
+
+@st.cache_resource
+def _directorio_usuarios():
+    return _DirectorioUsuarios()
+
+def _usuarios_vigentes(forzar=False):
+    """Retorna el directorio (recargandolo si expiro) o None si no hay conexion."""
+    directorio = _directorio_usuarios()
+    if forzar or not directorio.vigente():
+        ws = conectar_sheet_usuarios()
+        if not ws:
+            return None
+        with directorio.lock:
+            if forzar or not directorio.vigente():
+                directorio.cargar(ws)
+    return directorio
+
 def obtener_usuario(username):
-    ws = conectar_sheet_usuarios()
-    if not ws:
-        return None
     try:
-        for u in ws.get_all_records():
-            if u.get("username") == username:
-                return u
-        return None
+        directorio = _usuarios_vigentes()
+        if not directorio:
+            return None
+        entrada = directorio.usuarios.get(username)
+        return dict(entrada[1]) if entrada else None
     except Exception:
         return None
 
 def actualizar_password(username, nuevo_hash, debe_cambiar=False):
-    ws = conectar_sheet_usuarios()
-    if not ws:
+    directorio = _usuarios_vigentes()
+    if not directorio:
         return False
     try:
-        datos = ws.get_all_values()
-        for idx, fila in enumerate(datos[1:], start=2):
-            if fila[0] == username:
-                ws.update_cell(idx, 2, nuevo_hash)
-                ws.update_cell(idx, 5, str(debe_cambiar).upper())
-                return True
-        return False
+        with directorio.lock:
+            entrada = directorio.usuarios.get(username)
+            if not entrada:
+                return False
+            fila, registro = entrada
+            ws = conectar_sheet_usuarios()
+            if not ws:
+                return False
+            # Una sola peticion para las dos celdas de la fila del usuario
+            _api(ws, "batch_update", [
+                {"range": f"B{fila}", "values": [[nuevo_hash]]},
+                {"range": f"E{fila}", "values": [[str(debe_cambiar).upper()]]},
+            ])
+            registro["password_hash"]         = nuevo_hash
+            registro["debe_cambiar_password"] = str(debe_cambiar).upper()
+        return True
     except Exception as e:
+        _directorio_usuarios().invalidar()
         st.error(f"Error al actualizar contraseña: {e}")
         return False
 
 def crear_usuario(username, password_hash, nombre_completo, es_admin=False, debe_cambiar=True):
+    directorio = _usuarios_vigentes(forzar=True)
     ws = conectar_sheet_usuarios()
-    if not ws:
+    if not directorio or not ws:
         return False
     try:
-        if obtener_usuario(username):
-            return False
-        ws.append_row([username, password_hash, nombre_completo,
-                       str(es_admin).upper(), str(debe_cambiar).upper()])
+        with directorio.lock:
+            if username in directorio.usuarios:
+                return False
+            fila_nueva = [username, password_hash, nombre_completo,
+                          str(es_admin).upper(), str(debe_cambiar).upper()]
+            respuesta = _api(ws, "append_row", fila_nueva)
+            fila, _ = _filas_append(respuesta)
+            directorio.usuarios[username] = (fila, dict(zip(
+                ["username", "password_hash", "nombre_completo", "es_admin", "debe_cambiar_password"],
+                fila_nueva)))
         return True
     except Exception as e:
+        _directorio_usuarios().invalidar()
         st.error(f"Error al crear usuario: {e}")
         return False
 
 def listar_usuarios():
-    ws = conectar_sheet_usuarios()
-    if not ws:
-        return []
     try:
-        return ws.get_all_records()
+        directorio = _usuarios_vigentes()
+        if not directorio:
+            return []
+        return [dict(registro) for _, registro in sorted(directorio.usuarios.values(), key=lambda e: e[0])]
     except Exception:
         return []
 
@@ -168,34 +878,19 @@ def conectar_sheets_individual():
         spreadsheet = _get_spreadsheet()
 
         # Hoja de casos individuales
-        try:
-            hoja_casos = spreadsheet.worksheet("Individual")
-        except Exception:
-            hoja_casos = spreadsheet.add_worksheet(title="Individual", rows="1000", cols="20")
-
-        _sincronizar_encabezados(hoja_casos, [
-            "Timestamp", "OT-TE", "Edad", "Sexo",
-            "Departamento", "Municipio", "Solicitante",
-            "Nivel de Riesgo", "Observaciones",
-            "Analista", "Usuario Analista", "ID_Caso",
-            "Tipo de Estudio", "Año OT"
-        ])
+        hoja_casos = _hoja("Individual")
+
+        _asegurar_esquema(hoja_casos)
 
         # Hoja de hechos individuales
-        try:
-            hoja_hechos = spreadsheet.worksheet("Hechos_Individual")
-        except Exception:
-            hoja_hechos = spreadsheet.add_worksheet(title="Hechos_Individual", rows="1000", cols="20")
+        hoja_hechos = _hoja("Hechos_Individual")
 
-        _sincronizar_encabezados(hoja_hechos, [
-            "ID_Hecho", "ID_Caso", "OT-TE", "Tipo de Hecho",
-            "Fecha del Hecho", "Lugar", "Autor", "Descripcion",
-            "Analista", "Usuario Analista"
-        ])
+        _asegurar_esquema(hoja_hechos)
 
         return hoja_casos, hoja_hechos, spreadsheet.url
 
     except Exception as e:
+        _pool_hojas().invalidar()
         st.error(f"Error al conectar sheets individuales: {e}")
         return None, None, None
 
@@ -216,32 +911,19 @@ def conectar_sheets_colectivo():
         spreadsheet = _get_spreadsheet()
 
         # Hoja de casos colectivos
-        try:
-            hoja_casos = spreadsheet.worksheet("Colectivo")
-        except Exception:
-            hoja_casos = spreadsheet.add_worksheet(title="Colectivo", rows="1000", cols="20")
+        hoja_casos = _hoja("Colectivo")
 
-        _sincronizar_encabezados(hoja_casos, [
-            "Timestamp", "OT-TE", "Nombre Colectivo", "Fecha Creacion Colectivo",
-            "Sector", "Departamento", "Municipio",
-            "Analista", "Usuario Analista", "ID_Caso"
-        ])
+        _asegurar_esquema(hoja_casos)
 
         # Hoja de hechos colectivos
-        try:
-            hoja_hechos = spreadsheet.worksheet("Hechos_Colectivo")
-        except Exception:
-            hoja_hechos = spreadsheet.add_worksheet(title="Hechos_Colectivo", rows="1000", cols="20")
+        hoja_hechos = _hoja("Hechos_Colectivo")
 
-        _sincronizar_encabezados(hoja_hechos, [
-            "ID_Hecho", "ID_Caso", "OT-TE", "Tipo de Hecho",
-            "Fecha del Hecho", "Lugar", "Autor", "Descripcion",
-            "Analista", "Usuario Analista"
-        ])
+        _asegurar_esquema(hoja_hechos)
 
         return hoja_casos, hoja_hechos, spreadsheet.url
 
     except Exception as e:
+        _pool_hojas().invalidar()
         st.error(f"Error al conectar sheets colectivos: {e}")
         return None, None, None
 
@@ -251,116 +933,1555 @@ def conectar_sheets_colectivo():
 # ══════════════════════════════════════════════════════════════════════════════
 
 def obtener_siguiente_id(hoja):
-    return max(len(hoja.get_all_values()), 1)
+    return _indice(hoja).reservar_id()
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# REGISTRO DE ESQUEMAS
+# ══════════════════════════════════════════════════════════════════════════════
+
+# Subir la version obliga a revisar de nuevo los encabezados en cada proceso
+VERSION_ESQUEMAS = 3
+
+COLUMNAS_HECHOS = [
+    "ID_Hecho", "ID_Caso", "OT-TE", "Tipo de Hecho",
+    "Fecha del Hecho", "Lugar", "Autor", "Descripcion",
+    "Analista", "Usuario Analista", "ID_Solicitud",
+]
+
+ESQUEMAS = {
+    "Individual": [
+        "Timestamp", "OT-TE", "Edad", "Sexo",
+        "Departamento", "Municipio", "Solicitante",
+        "Nivel de Riesgo", "Observaciones",
+        "Analista", "Usuario Analista", "ID_Caso",
+        "Tipo de Estudio", "Año OT", "Mes OT", "ID_Solicitud",
+    ],
+    "Colectivo": [
+        "Timestamp", "OT-TE", "Nombre Colectivo", "Fecha Creacion Colectivo",
+        "Sector", "Departamento", "Municipio",
+        "Analista", "Usuario Analista", "ID_Caso", "ID_Solicitud",
+    ],
+    "Hechos_Individual": COLUMNAS_HECHOS,
+    "Hechos_Colectivo":  COLUMNAS_HECHOS,
+    "Borradores": [
+        "username", "tipo", "timestamp_guardado", "campos_json", "hechos_json",
+    ],
+    "Reservas_ID": [
+        "hoja", "minimo", "tamano", "proceso", "timestamp",
+    ],
+}
+
+class _RegistroEsquemas:
+    """
+    Encabezados reales de cada hoja, verificados una vez por proceso y por
+    version de esquema. Las columnas se ubican por nombre, asi que una hoja
+    con las columnas reordenadas a mano sigue funcionando.
+
+    La lectura de encabezados va sin lock (ver _PoolHojas); agregar columnas
+    faltantes se serializa por hoja y relee antes de escribir.
+    """
+
+    def __init__(self):
+        self.encabezados = {}   # (hoja, version) -> encabezados actuales
+        self.migrando    = {}   # titulo -> Lock de su migracion
+        self.lock        = threading.Lock()
+
+    def asegurar(self, hoja, prioridad=PRIORIDAD_REGISTRO):
+        clave = (hoja.title, VERSION_ESQUEMAS)
+        with self.lock:
+            if clave in self.encabezados:
+                return self.encabezados[clave]
+        esperados = ESQUEMAS.get(hoja.title, [])
+        actuales  = _api(hoja, "row_values", 1, prioridad=prioridad)
+        if any(col not in actuales for col in esperados):
+            with self.lock:
+                migracion = self.migrando.setdefault(hoja.title, threading.Lock())
+            with migracion:
+                with self.lock:
+                    if clave in self.encabezados:   # otro hilo ya las agrego
+                        return self.encabezados[clave]
+                actuales  = _api(hoja, "row_values", 1, prioridad=prioridad)
+                faltantes = [col for col in esperados if col not in actuales]
+                if faltantes:
+                    col_inicio = len(actuales) + 1
+                    exceso = col_inicio + len(faltantes) - 1 - hoja.col_count
+                    if exceso > 0:
+                        _api(hoja, "add_cols", exceso, prioridad=prioridad)
+                    # Todas las columnas faltantes en una sola escritura de la fila 1
+                    celda = gspread.utils.rowcol_to_a1(1, col_inicio)
+                    _api(hoja, "update", celda, [faltantes], prioridad=prioridad)
+                    actuales = actuales + faltantes
+                with self.lock:
+                    self.encabezados[clave] = actuales
+                return actuales
+        with self.lock:
+            self.encabezados[clave] = actuales
+        return actuales
+
+    def invalidar(self, nombre_hoja):
+        with self.lock:
+            self.encabezados.pop((nombre_hoja, VERSION_ESQUEMAS), None)
+
+@st.cache_resource
+def _registro_esquemas():
+    return _RegistroEsquemas()
+
+def _asegurar_esquema(hoja, prioridad=PRIORIDAD_REGISTRO):
+    """Retorna los encabezados actuales de la hoja, agregando los que falten."""
+    return _registro_esquemas().asegurar(hoja, prioridad)
+
+def _alinear_fila(encabezados, registro):
+    """Convierte un dict {columna: valor} en una fila en el orden real de la hoja."""
+    return ["" if registro.get(col) is None else registro.get(col) for col in encabezados]
+
+# ══════════════════════════════════════════════════════════════════════════════
+# VALIDACIÓN
+# ══════════════════════════════════════════════════════════════════════════════
+
+SEXOS          = ["Seleccione...", "Hombre", "Mujer", "Otro", "No Reporta"]
+SOLICITANTES   = ["Seleccione...", "ARN", "SESP", "OTRO"]
+TIPOS_ESTUDIO  = ["Seleccione...", "ORDEN DE TRABAJO OT", "TRÁMITE DE EMERGENCIA TE"]
+NIVELES_RIESGO = ["Seleccione...", "EXTRAORDINARIO", "EXTREMO", "ORDINARIO"]
+TIPOS_HECHO    = [
+    "Seleccione...", "Amenaza", "Atentado", "Desplazamiento forzado",
+    "Homicidio", "Secuestro", "Extorsión", "Reclutamiento forzado",
+    "Violencia sexual", "Confinamiento", "Otro",
+]
+AÑO_OT_MIN, AÑO_OT_MAX = 2000, 2026
+
+SECTORES_COLECTIVO = [
+    "Seleccione...",
+    "Comunidad campesina",
+    "Comunidad indígena",
+    "Comunidad afrodescendiente",
+    "Organización social",
+    "Organización sindical",
+    "Organización de mujeres",
+    "Organización de jóvenes",
+    "Organización LGBTIQ+",
+    "Defensores de DDHH",
+    "Líderes sociales",
+    "Otro",
+]
+
+# tipo de registro -> [(columna, regla, parametro, mensaje)], en el orden en que
+# se muestran los errores. Reglas: requerido, opciones, rango (min, max), fecha.
+CAMPOS_VALIDACION = {
+    "Individual": [
+        ("OT-TE",           "requerido", None,                      "El campo OT-TE es obligatorio"),
+        ("Edad",            "rango",     (1, 120),                  "La edad es obligatoria"),
+        ("Sexo",            "opciones",  SEXOS[1:],                 "Debe seleccionar un sexo"),
+        ("Departamento",    "requerido", None,                      "El departamento es obligatorio"),
+        ("Municipio",       "requerido", None,                      "El municipio es obligatorio"),
+        ("Solicitante",     "opciones",  SOLICITANTES[1:],          "Debe seleccionar una entidad solicitante"),
+        ("Nivel de Riesgo", "opciones",  NIVELES_RIESGO[1:],        "Debe seleccionar un nivel de riesgo"),
+        ("Tipo de Estudio", "opciones",  TIPOS_ESTUDIO[1:],         "Debe seleccionar un tipo de estudio"),
+        ("Año OT",          "rango",     (AÑO_OT_MIN, AÑO_OT_MAX),  "El año es obligatorio"),
+        ("Mes OT",          "rango",     (1, 12),                   "El mes es obligatorio"),
+    ],
+    "Colectivo": [
+        ("OT-TE",                    "requerido", None,                   "El campo OT-TE es obligatorio"),
+        ("Nombre Colectivo",         "requerido", None,                   "El nombre del colectivo es obligatorio"),
+        ("Fecha Creacion Colectivo", "fecha",     None,                   "La fecha de creacion debe ser AAAA-MM-DD"),
+        ("Sector",                   "opciones",  SECTORES_COLECTIVO[1:], "Debe seleccionar un sector"),
+        ("Departamento",             "requerido", None,                   "El departamento es obligatorio"),
+        ("Municipio",                "requerido", None,                   "El municipio es obligatorio"),
+    ],
+    "Hecho": [
+        ("Tipo de Hecho",   "opciones",  TIPOS_HECHO[1:], "Selecciona el tipo de hecho"),
+        ("Fecha del Hecho", "fecha",     None,            "La fecha del hecho debe ser AAAA-MM-DD"),
+        ("Lugar",           "requerido", None,            "El lugar es obligatorio"),
+        ("Autor",           "requerido", None,            "El autor es obligatorio"),
+        ("Descripcion",     "requerido", None,            "La descripción es obligatoria"),
+    ],
+}
+
+FORMATO_FECHA = "%Y-%m-%d"
+_PATRON_FECHA = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+
+def _fechas(serie):
+    """Fechas AAAA-MM-DD (como las guardan los formularios); lo demas queda NaT."""
+    return pd.to_datetime(serie, format=FORMATO_FECHA, errors="coerce")
+
+def _fecha_valida(texto):
+    """Exactamente AAAA-MM-DD y un dia que exista; mismo criterio que _fechas_validas."""
+    if not _PATRON_FECHA.fullmatch(texto):
+        return False
+    try:
+        datetime.strptime(texto, FORMATO_FECHA)
+        return True
+    except ValueError:
+        return False
 
-def _leer_con_retry(hoja, metodo="get_all_records", max_retries=4):
-    for intento in range(max_retries):
+def _fechas_validas(col):
+    return col.str.fullmatch(_PATRON_FECHA.pattern) & _fechas(col).notna()
+
+def _numero_en_rango(valor, minimo, maximo):
+    try:
+        return minimo <= float(valor) <= maximo
+    except (TypeError, ValueError):
+        return False
+
+def _valor_texto(valor):
+    """Un valor suelto normalizado igual que _texto normaliza una columna."""
+    return "" if valor is None or pd.isna(valor) else str(valor).strip()
+
+def _texto(serie):
+    return serie.fillna("").astype(str).str.strip()
+
+def _compilar_regla(regla, param):
+    """
+    Retorna (chequeo de un valor, chequeo de una columna); True donde el dato
+    es valido. Ambos reciben texto ya normalizado (_valor_texto / _texto).
+    """
+    if regla == "requerido":
+        return (lambda v: v != "",
+                lambda col: col != "")
+    if regla == "opciones":
+        conjunto = frozenset(param)
+        return (lambda v: v in conjunto,
+                lambda col: col.isin(conjunto))
+    if regla == "rango":
+        minimo, maximo = param
+        return (lambda v: _numero_en_rango(v, minimo, maximo),
+                lambda col: pd.to_numeric(col, errors="coerce").between(minimo, maximo))
+    if regla == "fecha":
+        return (_fecha_valida, _fechas_validas)
+    raise ValueError(f"Regla de validacion desconocida: {regla}")
+
+def _errores_por_fila(df, reglas):
+    """
+    Aplica [(mascara_de_error, mensaje), ...] y retorna los mensajes de cada
+    fila unidos por '; '. Cada fila se resume en un entero (un bit por regla)
+    y el texto se arma una sola vez por combinacion distinta de errores.
+    """
+    codigos = np.zeros(len(df), dtype=np.int64)
+    for bit, (mascara, _) in enumerate(reglas):
+        codigos |= np.asarray(mascara, dtype=bool).astype(np.int64) << bit
+    textos = {c: "; ".join(m for bit, (_, m) in enumerate(reglas) if c >> bit & 1)
+              for c in np.unique(codigos).tolist()}
+    return pd.Series(codigos, index=df.index).map(textos)
+
+class _Validador:
+    """
+    Esquema de un tipo de registro compilado a chequeos listos para usar:
+    fila() valida un dict (formularios) y tabla() valida un DataFrame
+    completo columna por columna (importacion masiva).
+    """
+
+    def __init__(self, campos):
+        self.campos = [(col, *_compilar_regla(regla, param), mensaje)
+                       for col, regla, param, mensaje in campos]
+
+    def fila(self, registro):
+        return [mensaje for col, valido, _, mensaje in self.campos if not valido(_valor_texto(registro.get(col)))]
+
+    def tabla(self, df, extra=()):
+        """Errores de cada fila unidos por '; ' ("" si es valida); extra son (mascara, mensaje) adicionales."""
+        faltante = pd.Series(True, index=df.index)
+        reglas = [(~valido(_texto(df[col])) if col in df.columns else faltante, mensaje)
+                  for col, _, valido, mensaje in self.campos]
+        return _errores_por_fila(df, reglas + list(extra))
+
+VALIDADORES = {tipo: _Validador(campos) for tipo, campos in CAMPOS_VALIDACION.items()}
+
+# ══════════════════════════════════════════════════════════════════════════════
+# SINCRONIZACIÓN INCREMENTAL
+# ══════════════════════════════════════════════════════════════════════════════
+
+RECONCILIACION_COMPLETA_SEG = 300   # cada cuanto se relee la hoja completa
+PANEL_CACHE_TTL_SEG        = 60    # cubre ediciones hechas directamente en Sheets
+
+class _EspejoHoja:
+    """
+    Copia en memoria de una hoja, compartida por todas las sesiones del proceso.
+
+    En cada refresco solo se leen las filas agregadas despues de la ultima
+    fila conocida (lectura de rango sobre la cola). Cada
+    RECONCILIACION_COMPLETA_SEG se relee la hoja completa para recoger
+    ediciones o borrados hechos a mano en Google Sheets.
+    """
+
+    def __init__(self, nombre):
+        self.nombre               = nombre
+        self.encabezados          = []
+        self.filas                = []
+        self.ultima_lectura       = 0.0
+        self.ultima_reconciliacion = 0.0
+        self.version              = 0   # cambia con cada lectura completa
+        self.revision             = 0   # cambia cada vez que cambian las filas
+        self.lock                 = threading.Lock()
+
+    def _ancho(self):
+        return max(len(self.encabezados), 1)
+
+    def _normalizar(self, fila):
+        ancho = self._ancho()
+        fila  = [str(v) for v in fila[:ancho]]
+        return fila + [""] * (ancho - len(fila))
+
+    def plan_refresco(self, max_edad=0):
+        """
+        Retorna (rango A1, es_completa, filas_conocidas, version) con lo que hay
+        que leer para ponerse al dia, o None si el espejo tiene menos de
+        max_edad segundos.
+        """
+        with self.lock:
+            ahora = time.time()
+            if self.encabezados and ahora - self.ultima_lectura < max_edad:
+                return None
+            if not self.encabezados or ahora - self.ultima_reconciliacion > RECONCILIACION_COMPLETA_SEG:
+                return f"'{self.nombre}'", True, 0, self.version
+            letra = gspread.utils.rowcol_to_a1(1, self._ancho()).rstrip("0123456789")
+            return f"'{self.nombre}'!A{len(self.filas) + 2}:{letra}", False, len(self.filas), self.version
+
+    def aplicar(self, plan, valores):
+        """Incorpora el resultado de leer el rango de plan_refresco; retorna las filas nuevas."""
+        _, completa, conocidas, version = plan
+        with self.lock:
+            if not completa and (self.version != version or len(self.filas) != conocidas):
+                return []   # otro hilo ya actualizo el espejo mientras se leia
+            if completa:
+                self.encabezados = valores[0] if valores else []
+                self.filas       = [self._normalizar(f) for f in valores[1:]]
+                self.ultima_reconciliacion = time.time()
+                self.version    += 1
+                nuevas = list(self.filas)
+            else:
+                nuevas = [self._normalizar(f) for f in valores]
+                self.filas.extend(nuevas)
+            if completa or nuevas:
+                self.revision += 1
+            self.ultima_lectura = time.time()
+            return nuevas
+
+    def refrescar(self, hoja, max_edad=0, prioridad=PRIORIDAD_REGISTRO):
+        """
+        Actualiza el espejo leyendo solo esta hoja; retorna las filas nuevas.
+        Con prioridad de panel y sin cuota disponible se conservan los datos
+        actuales (aunque esten viejos) en lugar de esperar turno.
+        """
+        plan = self.plan_refresco(max_edad)
+        if plan is None:
+            return []
+        rango, completa, _, _ = plan
+        bloquear = prioridad != PRIORIDAD_PANEL or not self.encabezados
         try:
-            return getattr(hoja, metodo)()
-        except Exception as e:
-            if "429" in str(e):
-                time.sleep((2 ** intento) + 1)
+            if completa:
+                valores = _api(hoja, "get_all_values", prioridad=prioridad, bloquear=bloquear)
             else:
-                raise
-    raise Exception(f"Cuota agotada tras {max_retries} intentos")
+                valores = _api(hoja, "get", rango.split("!")[1], prioridad=prioridad, bloquear=bloquear)
+        except CuotaDiferida:
+            return []
+        return self.aplicar(plan, valores)
+
+    def invalidar(self):
+        """Fuerza una reconciliacion completa en el proximo refresco."""
+        with self.lock:
+            self.ultima_reconciliacion = 0.0
+            self.ultima_lectura        = 0.0
+
+    def dataframe(self):
+        """(revision, DataFrame) de una misma vista del espejo."""
+        with self.lock:
+            df = pd.DataFrame(self.filas, columns=self.encabezados) if self.encabezados else pd.DataFrame()
+            return self.revision, df
+
+    def columna(self, nombre_col, desde=0):
+        with self.lock:
+            if nombre_col not in self.encabezados:
+                return []
+            idx = self.encabezados.index(nombre_col)
+            return [f[idx] for f in self.filas[desde:]]
+
+@st.cache_resource
+def _espejo(nombre_hoja):
+    return _EspejoHoja(nombre_hoja)
+
+COLUMNA_ID = {
+    "Individual":        "ID_Caso",
+    "Colectivo":         "ID_Caso",
+    "Hechos_Individual": "ID_Hecho",
+    "Hechos_Colectivo":  "ID_Hecho",
+}
 
-def _sincronizar_encabezados(hoja, encabezados_esperados):
+class _IndiceHoja:
     """
-    Compara los encabezados actuales de la hoja con los esperados.
-    Si faltan columnas, las agrega al final automaticamente.
-    Si la hoja esta vacia, escribe todos los encabezados desde cero.
-    Usa cache de sesion para ejecutarse solo una vez por hoja y evitar
-    gastar cuota de lectura de la API en cada recarga de la app.
+    Indice hash de OT-TE y bloque de IDs reservado para una hoja.
+
+    Se construye perezosamente a partir del espejo y absorbe solo las filas
+    nuevas que el espejo haya leido; si el espejo hizo una reconciliacion
+    completa, el indice se reconstruye. Las escrituras propias lo actualizan
+    directamente, asi que en regimen estable no cuesta lecturas a la API.
+    Los IDs salen de bloques reservados en la hoja Reservas_ID (ver
+    _ReservasIds); ultimo_id es solo el mayor ID visto y sirve de minimo
+    para el siguiente bloque.
+
+    Los OT-TE apartados con reclamar_ot que aun no estan en la cola ni en la
+    hoja viven en reclamados, aparte de ot_te: una reconstruccion vacia
+    ot_te y no debe soltarlos. Salen con confirmar_ot o liberar_ot.
     """
-    cache_key = f"_headers_synced_{hoja.title}"
-    if st.session_state.get(cache_key):
-        return
-    valores = hoja.get_all_values()
-    if not valores:
-        hoja.append_row(encabezados_esperados)
-    else:
-        encabezados_actuales = valores[0]
-        faltantes = [col for col in encabezados_esperados if col not in encabezados_actuales]
-        if faltantes:
-            col_inicio = len(encabezados_actuales) + 1
-            for i, nombre_col in enumerate(faltantes):
-                hoja.update_cell(1, col_inicio + i, nombre_col)
-    st.session_state[cache_key] = True
+
+    def __init__(self, nombre):
+        self.nombre       = nombre
+        self.col_id       = COLUMNA_ID.get(nombre, "ID_Caso")
+        self.ot_te        = set()
+        self.reclamados   = set()
+        self.ultimo_id    = 0
+        self.version      = None
+        self.filas_vistas = 0
+        self.bloque       = None   # [siguiente, fin] del bloque reservado en uso
+        self.lock         = threading.Lock()
+        self.lock_ids     = threading.Lock()   # aparte: reservar un bloque llama a la API
+
+    def _absorber(self, espejo):
+        # Version y filas nuevas en una sola vista del espejo: una lectura de
+        # la cola entre dos columnas desalinearia filas_vistas
+        with espejo.lock:
+            reinicio = self.version != espejo.version
+            if reinicio:
+                self.ot_te, self.filas_vistas = set(), 0
+                self.version = espejo.version
+            posiciones = [espejo.encabezados.index(c) if c in espejo.encabezados else None
+                          for c in ("OT-TE", self.col_id)]
+            nuevas     = espejo.filas[self.filas_vistas:]
+        if reinicio:
+            # Registros aun en la cola local: ocupan OT-TE e IDs aunque no esten en la hoja
+            ots_pendientes, max_id_pendiente = _cola().pendientes_hoja(self.nombre)
+            self.ot_te.update(ots_pendientes)
+            self.ultimo_id = max(self.ultimo_id, max_id_pendiente)
+        i_ot, i_id = posiciones
+        for fila in nuevas:
+            if i_ot is not None and fila[i_ot].strip():
+                self.ot_te.add(fila[i_ot].strip())
+            if i_id is not None:
+                try:
+                    self.ultimo_id = max(self.ultimo_id, int(float(fila[i_id])))
+                except ValueError:
+                    pass
+        self.filas_vistas += len(nuevas)
+        # Compatibilidad con hojas antiguas sin IDs: nunca por debajo del numero de filas
+        self.ultimo_id = max(self.ultimo_id, self.filas_vistas)
+
+    def sincronizar(self, hoja):
+        espejo = _espejo(self.nombre)
+        espejo.refrescar(hoja, max_edad=RECONCILIACION_COMPLETA_SEG)
+        with self.lock:
+            self._absorber(espejo)
+        return self
+
+    def reclamar_ot(self, ot_te):
+        """
+        Verifica y aparta el OT-TE en un solo paso bajo el lock del indice, asi
+        dos sesiones del mismo proceso no pueden registrar el mismo OT-TE.
+        Retorna False si ya existia.
+        """
+        with self.lock:
+            if ot_te.strip() in self.ot_te or ot_te.strip() in self.reclamados:
+                return False
+            self.reclamados.add(ot_te.strip())
+            return True
+
+    def confirmar_ot(self, ot_te):
+        """El registro ya esta en la cola (o en la hoja): el OT-TE pasa a los conocidos."""
+        with self.lock:
+            self.reclamados.discard(ot_te.strip())
+            self.ot_te.add(ot_te.strip())
+
+    def liberar_ot(self, ot_te):
+        """Deshace reclamar_ot cuando el registro no llego a encolarse."""
+        with self.lock:
+            self.reclamados.discard(ot_te.strip())
+
+    def ots(self):
+        """Copia de los OT-TE conocidos y apartados, para validar muchos de una vez."""
+        with self.lock:
+            return self.ot_te | self.reclamados
+
+    def reservar_id(self):
+        return self.reservar_ids(1)[0]
+
+    def reservar_ids(self, cantidad):
+        """IDs unicos entre sesiones y replicas; solo llama a la API al agotar el bloque."""
+        ids = []
+        with self.lock_ids:
+            while len(ids) < cantidad:
+                if self.bloque is None or self.bloque[0] > self.bloque[1]:
+                    with self.lock:
+                        minimo = self.ultimo_id + 1
+                    tamano = max(BLOQUE_IDS, cantidad - len(ids))
+                    self.bloque = list(_reservas_ids().reservar(self.nombre, minimo, tamano))
+                tomar = min(cantidad - len(ids), self.bloque[1] - self.bloque[0] + 1)
+                ids.extend(range(self.bloque[0], self.bloque[0] + tomar))
+                self.bloque[0] += tomar
+        with self.lock:
+            self.ultimo_id = max(self.ultimo_id, ids[-1]) if ids else self.ultimo_id
+        return ids
+
+    def registrar(self, ot_te=None, id_valor=None):
+        with self.lock:
+            if ot_te:
+                self.ot_te.add(ot_te.strip())
+            if id_valor is not None:
+                self.ultimo_id = max(self.ultimo_id, int(id_valor))
+
+@st.cache_resource
+def _indice_hoja(nombre_hoja):
+    return _IndiceHoja(nombre_hoja)
+
+def _indice(hoja):
+    """Retorna el indice de la hoja, sincronizado con su espejo."""
+    return _indice_hoja(hoja.title).sincronizar(hoja)
+
+HOJAS_PANEL = ("Individual", "Hechos_Individual", "Colectivo", "Hechos_Colectivo")
+COLUMNAS_AGREGADAS  = ("Departamento", "Municipio", "Nivel de Riesgo", "Sector",
+                       "Analista", "Tipo de Hecho", "ID_Caso")
+NIVELES_RIESGO_ALTO = ("EXTREMO", "EXTRAORDINARIO")
+COLUMNAS_FILTRO     = ("Departamento", "Nivel de Riesgo", "Analista", "Sector", "Tipo de Hecho")
+COLUMNAS_CATEGORIA  = COLUMNAS_FILTRO + ("Sexo", "Municipio", "Solicitante", "Usuario Analista",
+                                         "Tipo de Estudio", "Año OT", "Mes OT")
+COLUMNAS_ENTERAS    = ("ID_Caso", "ID_Hecho", "Edad")
+
+def _modelo_compacto(df):
+    """Columnas repetitivas como category y numericas como Int64 (en lugar de object)."""
+    for col in df.columns:
+        if col in COLUMNAS_ENTERAS:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
+        elif col in COLUMNAS_CATEGORIA:
+            df[col] = df[col].astype("category")
+    return df
+
+def _indice_filtros(df):
+    """
+    {columna: {valor: posiciones ordenadas}} para las columnas de filtro.
+    Se arma con un solo argsort por columna sobre los codigos de categoria.
+    """
+    indice = {}
+    for col in COLUMNAS_FILTRO:
+        if col not in df.columns or not isinstance(df[col].dtype, pd.CategoricalDtype):
+            continue
+        codigos = df[col].cat.codes.to_numpy()
+        orden   = np.argsort(codigos, kind="stable")
+        cortes  = np.cumsum(np.bincount(codigos[codigos >= 0], minlength=len(df[col].cat.categories)))
+        inicio  = int((codigos < 0).sum())   # los nulos (codigo -1) quedan al principio
+        indice[col] = {v: orden[inicio + a:inicio + b]
+                       for v, a, b in zip(df[col].cat.categories, np.r_[0, cortes[:-1]], cortes)}
+    return indice
+
+def _filtrar(df, indice, filtros):
+    """
+    Aplica {columna: valor} intersectando las posiciones del indice; "Todos"
+    no filtra. Sin filtros activos retorna el mismo DataFrame, sin copiarlo.
+    """
+    seleccion = None
+    for col, valor in filtros.items():
+        if valor == "Todos" or col not in indice:
+            continue
+        posiciones = indice[col].get(valor, np.empty(0, dtype=np.intp))
+        seleccion  = posiciones if seleccion is None else np.intersect1d(seleccion, posiciones, assume_unique=True)
+    if seleccion is None:
+        return df
+    vista = df.iloc[seleccion]
+    _anotar_memoria(vista.memory_usage(deep=True).sum())
+    return vista
+
+class _AgregadosHoja:
+    """
+    Conteos por valor de las columnas de COLUMNAS_AGREGADAS de una hoja.
+
+    Igual que el indice, absorbe solo las filas nuevas del espejo y se
+    reconstruye cuando este hace una lectura completa. resumen() entrega
+    lo que necesitan las metricas y los filtros del panel ya calculado.
+    """
+
+    def __init__(self, nombre):
+        self.nombre       = nombre
+        self.conteos      = {}
+        self.version      = None
+        self.filas_vistas = 0
+
+    def absorber(self, espejo):
+        with espejo.lock:
+            if self.version != espejo.version:
+                self.filas_vistas = 0
+                self.conteos = {c: Counter() for c in COLUMNAS_AGREGADAS if c in espejo.encabezados}
+                self.version = espejo.version
+            posiciones = {c: espejo.encabezados.index(c) for c in self.conteos}
+            nuevas     = espejo.filas[self.filas_vistas:]
+        for col, i in posiciones.items():
+            self.conteos[col].update(f[i] for f in nuevas)
+        self.filas_vistas += len(nuevas)
+
+    def resumen(self):
+        return {
+            "total":     self.filas_vistas,
+            "conteos":   {c: dict(v) for c, v in self.conteos.items()},
+            "distintos": {c: len(v) for c, v in self.conteos.items()},
+            "opciones":  {c: ["Todos"] + sorted(v) for c, v in self.conteos.items()},
+        }
+
+def _clave_caso(valor):
+    """ID_Caso normalizado: "12", "12.0" y 12 son la misma clave."""
+    try:
+        return int(float(valor))
+    except (TypeError, ValueError):
+        return str(valor).strip()
+
+class _IndiceUnion:
+    """
+    ID_Caso -> posiciones de sus filas en una hoja de hechos.
+
+    Absorbe solo las filas nuevas del espejo. Tras una lectura completa se
+    arma un dict nuevo en lugar de vaciar el actual, asi las instantaneas
+    anteriores del panel siguen viendo un indice coherente con su DataFrame.
+    """
+
+    def __init__(self, nombre):
+        self.nombre       = nombre
+        self.posiciones   = {}
+        self.version      = None
+        self.filas_vistas = 0
+
+    def absorber(self, espejo):
+        with espejo.lock:
+            if self.version != espejo.version:
+                self.posiciones, self.filas_vistas = {}, 0
+                self.version = espejo.version
+            if "ID_Caso" not in espejo.encabezados:
+                return
+            col    = espejo.encabezados.index("ID_Caso")
+            nuevas = espejo.filas[self.filas_vistas:]
+        for pos, fila in enumerate(nuevas, start=self.filas_vistas):
+            self.posiciones.setdefault(_clave_caso(fila[col]), []).append(pos)
+        self.filas_vistas += len(nuevas)
+
+class _InstantaneaPanel:
+    """
+    DataFrames de las cuatro hojas del panel, compartidos por todas las
+    sesiones. Un refresco pone al dia los cuatro espejos con una sola
+    peticion values_batch_get y solo reconstruye los DataFrames de las
+    hojas cuyo espejo cambio.
+    """
+
+    def __init__(self):
+        self.tablas     = {n: pd.DataFrame() for n in HOJAS_PANEL}
+        self.filtros    = {n: {} for n in HOJAS_PANEL}
+        self.agregados  = {n: _AgregadosHoja(n) for n in HOJAS_PANEL}
+        self.uniones    = {n: _IndiceUnion(n) for n in HOJAS_PANEL if n.startswith("Hechos_")}
+        self.resumenes  = {n: self.agregados[n].resumen() for n in HOJAS_PANEL}
+        self.revisiones = {n: None for n in HOJAS_PANEL}
+        self.leida      = None
+        self.lock       = threading.Lock()
+
+    def refrescar(self, max_edad=0):
+        with self.lock:
+            espejos = {n: _espejo(n) for n in HOJAS_PANEL}
+            planes  = {n: e.plan_refresco(max_edad) for n, e in espejos.items()}
+            planes  = {n: p for n, p in planes.items() if p}
+            if planes:
+                for n in planes:
+                    _hoja(n, prioridad=PRIORIDAD_PANEL)   # crea la hoja si aun no existe
+                try:
+                    respuesta = _api(
+                        _get_spreadsheet(), "values_batch_get", [p[0] for p in planes.values()],
+                        prioridad=PRIORIDAD_PANEL, bloquear=self.leida is None)
+                    for (n, plan), rango in zip(planes.items(), respuesta.get("valueRanges", [])):
+                        espejos[n].aplicar(plan, rango.get("values", []))
+                    self.leida = datetime.now()
+                except CuotaDiferida:
+                    pass   # se sirve la instantanea anterior
+            for n, espejo in espejos.items():
+                if self.revisiones[n] != espejo.revision:
+                    # La revision sale de la misma vista que las filas: si otro hilo
+                    # lee la cola del espejo mientras tanto, el proximo refresco lo nota
+                    revision, df       = espejo.dataframe()
+                    self.tablas[n]     = _modelo_compacto(df)
+                    self.filtros[n]    = _indice_filtros(self.tablas[n])
+                    self.agregados[n].absorber(espejo)
+                    if n in self.uniones:
+                        self.uniones[n].absorber(espejo)
+                    self.resumenes[n]  = self.agregados[n].resumen()
+                    self.revisiones[n] = revision
+            return self
+
+@st.cache_resource
+def _instantanea_panel():
+    return _InstantaneaPanel()
+
+class _VersionDatos:
+    """Contador que sube con cada escritura de la app; forma la clave de la cache del panel."""
+
+    def __init__(self):
+        self.valor = 0
+        self.lock  = threading.Lock()
+
+    def incrementar(self):
+        with self.lock:
+            self.valor += 1
+
+@st.cache_resource
+def _version_datos():
+    return _VersionDatos()
+
+@st.cache_resource(ttl=PANEL_CACHE_TTL_SEG, max_entries=2, show_spinner=False)
+def _tablas_panel(version):
+    """
+    DataFrames del panel para una version de los datos. Cambiar un filtro
+    no toca la red: solo una escritura nueva (o el TTL) provoca otra lectura.
+    Se comparten sin copiar entre sesiones, por eso el panel nunca los modifica.
+    """
+    snap    = _instantanea_panel().refrescar()
+    uniones = {n: u.posiciones for n, u in snap.uniones.items()}
+    return (dict(snap.tablas), dict(snap.filtros), dict(snap.resumenes), uniones, snap.leida,
+            dict(snap.revisiones))
 
 # ══════════════════════════════════════════════════════════════════════════════
-# BORRADORES
+# RESERVA DE IDS
+# ══════════════════════════════════════════════════════════════════════════════
+
+BLOQUE_IDS = 20
+PROCESO_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+class _ReservasIds:
+    """
+    Asignador de bloques de IDs compartido por todas las replicas de la app.
+
+    Google Sheets no ofrece compare-and-swap, pero si un orden total de los
+    append: cada reserva agrega una fila (hoja, minimo, tamano) a Reservas_ID
+    y el bloque que le toca se deduce plegando todas las filas en orden. Para
+    cada hoja el bloque de una fila empieza en max(fin del bloque anterior + 1,
+    minimo). Todas las replicas pliegan las mismas filas en el mismo orden, asi
+    que los bloques nunca se solapan. Los IDs no usados de un bloque quedan
+    como huecos y los borrados en la hoja de datos nunca se reutilizan.
+    La hoja Reservas_ID no debe editarse a mano.
+    """
+
+    def __init__(self):
+        self.fin     = {}   # hoja -> ultimo ID cubierto por el pliegue
+        self.bloques = []   # por fila de Reservas_ID: (hoja, inicio, fin) o None
+        self.version = None
+        self.lock    = threading.Lock()
+
+    def _plegar(self, espejo):
+        with espejo.lock:
+            if self.version != espejo.version:
+                self.fin, self.bloques, self.version = {}, [], espejo.version
+            columnas = [espejo.encabezados.index(c) for c in ("hoja", "minimo", "tamano")]
+            nuevas   = espejo.filas[len(self.bloques):]
+        for fila in nuevas:
+            hoja, minimo, tamano = (fila[i] for i in columnas)
+            try:
+                minimo, tamano = int(minimo), int(tamano)
+            except ValueError:
+                self.bloques.append(None)
+                continue
+            inicio = max(self.fin.get(hoja, 0) + 1, minimo)
+            self.fin[hoja] = inicio + tamano - 1
+            self.bloques.append((hoja, inicio, self.fin[hoja]))
+
+    def reservar(self, nombre_hoja, minimo, tamano, intentos=5):
+        """Reserva tamano IDs >= minimo para nombre_hoja; retorna (inicio, fin)."""
+        hoja = _hoja("Reservas_ID")
+        encabezados = _asegurar_esquema(hoja)
+        respuesta = _api(hoja, "append_rows", [_alinear_fila(encabezados, {
+            "hoja": nombre_hoja, "minimo": minimo, "tamano": tamano, "proceso": PROCESO_ID,
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        })])
+        posicion = _filas_append(respuesta)[0] - 2   # fila 1 = encabezados
+        espejo = _espejo("Reservas_ID")
+        with self.lock:
+            for _ in range(intentos):
+                if len(self.bloques) > posicion:
+                    break
+                espejo.refrescar(hoja)   # lectura de cola hasta incluir la fila propia
+                self._plegar(espejo)
+            if len(self.bloques) <= posicion or not self.bloques[posicion] \
+                    or self.bloques[posicion][0] != nombre_hoja:
+                espejo.invalidar()
+                raise Exception("No se pudo confirmar la reserva de IDs; intente de nuevo")
+            _, inicio, fin = self.bloques[posicion]
+        return inicio, fin
+
+@st.cache_resource
+def _reservas_ids():
+    return _ReservasIds()
+
+# ══════════════════════════════════════════════════════════════════════════════
+# REGISTRO DE CASOS
 # ══════════════════════════════════════════════════════════════════════════════
 
-def _conectar_hoja_borradores():
-    """Retorna la hoja Borradores del spreadsheet principal, creandola si no existe."""
+def _filas_append(respuesta):
+    """Primera y ultima fila escritas segun la respuesta de append_rows."""
+    rango = respuesta["updates"]["updatedRange"].split("!")[-1]
+    filas = [int(n) for n in re.findall(r"[A-Z]+(\d+)", rango)]
+    return filas[0], filas[-1]
+
+def _registros_hechos(ids_hecho, id_caso, ot_te, hechos):
+    """Registros {columna: valor} de los hechos de un caso, listos para encolar."""
+    return [
+        {
+            "ID_Hecho": id_hecho, "ID_Caso": id_caso, "OT-TE": ot_te,
+            "Tipo de Hecho": hecho["tipo"], "Fecha del Hecho": hecho["fecha"],
+            "Lugar": hecho["lugar"], "Autor": hecho["autor"], "Descripcion": hecho["descripcion"],
+            "Analista": st.session_state.nombre_completo,
+            "Usuario Analista": st.session_state.username,
+        }
+        for id_hecho, hecho in zip(ids_hecho, hechos)
+    ]
+
+def _sin_escribir(hoja, filas):
+    """Filas cuya ID_Solicitud aun no aparece en la hoja (releyendo su cola)."""
+    if not filas:
+        return filas
+    col    = _asegurar_esquema(hoja).index("ID_Solicitud")
+    espejo = _espejo(hoja.title)
+    espejo.refrescar(hoja)
+    if "ID_Solicitud" not in espejo.encabezados:   # espejo leido antes de agregar la columna
+        espejo.invalidar()
+        espejo.refrescar(hoja)
+    escritas = set(espejo.columna("ID_Solicitud")) - {""}
+    return [f for f in filas if f[col] not in escritas]
+
+def registrar_casos_con_hechos(hoja_casos, hoja_hechos, filas_casos, filas_hechos,
+                               prioridad=PRIORIDAD_REGISTRO, verificar=False):
+    """
+    Escribe las filas de uno o varios casos y todas las de sus hechos en como
+    maximo dos peticiones (un append_rows por hoja).
+
+    Si falla la escritura de los hechos se eliminan las filas de casos recien
+    agregadas, de modo que el registro es todo o nada. Se ubican por su
+    ID_Caso y no por los numeros de fila del append, que quedan viejos si
+    otra sesion o replica borra filas encima. Si tambien falla la reversion,
+    el error lo indica para que se revise la hoja a mano.
+
+    Con verificar=True (reintento tras un fallo que pudo haberse aplicado) se
+    omiten las filas cuya ID_Solicitud ya esta en la hoja.
+    """
+    if verificar:
+        filas_casos  = _sin_escribir(hoja_casos, filas_casos)
+        filas_hechos = _sin_escribir(hoja_hechos, filas_hechos)
+    respuesta = _api(hoja_casos, "append_rows", filas_casos, prioridad=prioridad) if filas_casos else None
+    if not filas_hechos:
+        return
     try:
-        creds, _ = _credenciales()
-        client = gspread.authorize(creds)
-        spreadsheet = client.open(st.secrets.get("sheet_name", "ISMR_Casos"))
-        try:
-            hoja = spreadsheet.worksheet("Borradores")
-        except Exception:
-            hoja = spreadsheet.add_worksheet(title="Borradores", rows="500", cols="10")
-        _sincronizar_encabezados(hoja, [
-            "username", "tipo", "timestamp_guardado", "campos_json", "hechos_json"
-        ])
-        return hoja
+        _api(hoja_hechos, "append_rows", filas_hechos, prioridad=prioridad)
     except Exception as e:
-        st.error(f"Error al conectar hoja de borradores: {e}")
-        return None
+        if respuesta is None:
+            raise
+        try:
+            col_id = _asegurar_esquema(hoja_casos).index("ID_Caso")
+            _eliminar_filas_casos(hoja_casos, [fila[col_id] for fila in filas_casos])
+        except Exception as e_rev:
+            raise Exception(
+                f"No se guardaron los hechos ({e}) y no se pudo revertir el caso; "
+                f"revise la hoja {hoja_casos.title} ({e_rev})"
+            )
+        raise Exception(f"No se guardaron los hechos; el caso no fue registrado ({e})") from e
 
-def guardar_borrador(tipo, campos, hechos):
-    import json
-    hoja = _conectar_hoja_borradores()
-    if not hoja:
-        return False
+
+def _letra_columna(hoja, nombre_col):
+    encabezados = _asegurar_esquema(hoja)
+    return gspread.utils.rowcol_to_a1(1, encabezados.index(nombre_col) + 1)[:-1]
+
+def _leer_columnas(hoja, nombres):
+    """
+    Columnas completas (sin encabezado) leidas en una sola peticion y sin
+    pasar por el espejo, que solo relee la cola y no ve filas que otra
+    replica ya borro. Todas quedan del mismo largo.
+    """
+    rangos = [f"'{hoja.title}'!{_letra_columna(hoja, n)}2:{_letra_columna(hoja, n)}" for n in nombres]
+    respuesta = _api(hoja.spreadsheet, "values_batch_get", rangos)
+    columnas = [[fila[0] if fila else "" for fila in r.get("values", [])]
+                for r in respuesta.get("valueRanges", [])]
+    largo = max(map(len, columnas), default=0)
+    return [c + [""] * (largo - len(c)) for c in columnas]
+
+def _descartar_duplicados(hoja_c, hoja_h, casos):
+    """
+    Verificacion posterior al append para [(ot_te, id_caso), ...] recien
+    escritos. El lock por OT-TE solo cubre este proceso; otra replica pudo
+    escribir el mismo OT-TE a la vez. Releyendo completas las columnas OT-TE
+    e ID_Caso gana la fila que quedo primero, y los casos propios que
+    perdieron se eliminan con sus hechos. Ambas replicas llegan a la misma
+    conclusion porque comparan el mismo orden de filas. Retorna los ID_Caso
+    descartados.
+    """
+    primero = {}
+    for ot, id_caso in zip(*_leer_columnas(hoja_c, ["OT-TE", "ID_Caso"])):
+        primero.setdefault(ot.strip(), _clave_caso(id_caso))
+    perdedores = {id_caso for ot, id_caso in casos if ot in primero and primero[ot] != id_caso}
+    if perdedores:
+        _eliminar_filas_casos(hoja_c, perdedores)
+        _eliminar_filas_casos(hoja_h, perdedores)
+    return perdedores
+
+ELIMINACION_INTENTOS = 3
+
+def _eliminar_filas_casos(hoja, ids_caso):
+    """
+    Elimina de la hoja las filas con esos ID_Caso (unicos entre replicas), de
+    abajo hacia arriba y por tramos contiguos, ubicandolas con una lectura
+    completa de la columna ID_Caso. Justo antes de cada delete_rows se relee
+    el tramo; si ya no tiene esos ID_Caso (otra replica borro filas encima)
+    se vuelven a ubicar todas.
+    """
+    ids_caso = {_clave_caso(i) for i in ids_caso}
+    letra = _letra_columna(hoja, "ID_Caso")
     try:
-        username  = st.session_state.username
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        campos_json = json.dumps(campos, ensure_ascii=False)
-        hechos_json = json.dumps(hechos, ensure_ascii=False)
-        datos = hoja.get_all_values()
+        for _ in range(ELIMINACION_INTENTOS):
+            ids, = _leer_columnas(hoja, ["ID_Caso"])
+            tramos = []
+            for fila in (i + 2 for i, v in enumerate(ids) if _clave_caso(v) in ids_caso):
+                if tramos and tramos[-1][1] == fila - 1:
+                    tramos[-1][1] = fila
+                else:
+                    tramos.append([fila, fila])
+            for inicio, fin in reversed(tramos):
+                actual = _api(hoja, "get", f"{letra}{inicio}:{letra}{fin}")
+                if (len(actual) != fin - inicio + 1
+                        or any(_clave_caso(f[0] if f else "") not in ids_caso for f in actual)):
+                    break
+                _api(hoja, "delete_rows", inicio, fin)
+            else:
+                return
+        raise Exception(f"Las filas de los casos {sorted(ids_caso, key=str)} en {hoja.title} "
+                        "se movieron mientras se eliminaban")
+    finally:
+        _espejo(hoja.title).invalidar()
+
+# ══════════════════════════════════════════════════════════════════════════════
+# COLA DE ESCRITURA
+# ══════════════════════════════════════════════════════════════════════════════
+
+COLA_DB_PATH         = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ismr_cola.db")
+COLA_LOTE_MAX        = 50    # casos por lote enviado a Google Sheets
+COLA_ESPERA_SEG      = 5     # sondeo del worker cuando no hay avisos
+COLA_BACKOFF_MAX_SEG = 300
+COLA_RECLAMO_MAX_SEG = 600   # un lote 'enviando' mas viejo se da por abandonado
+COLA_VERIFICACION_SEG = 10   # cada cuanto se buscan duplicados entre replicas en lo escrito
+
+def _hilo_de_fondo(hilo):
+    """
+    Da al hilo un contexto de script propio, sin sesion detras: en Streamlit
+    1.31 st.cache_resource no encuentra nada sin contexto y el hilo crearia su
+    propio cliente, pool de hojas y planificador en cada llamada. Con el
+    contexto de una sesion real esta seguiria viva mientras viva el hilo y
+    recibiria lo que el hilo dibuje (p.ej. el spinner de un cache miss); este
+    descarta todo mensaje.
+    """
+    add_script_run_ctx(hilo, ScriptRunContext(
+        session_id=f"{hilo.name}-sin-sesion", _enqueue=lambda mensaje: None, query_string="",
+        session_state=SafeSessionState(SessionState(), lambda: None), uploaded_file_mgr=None,
+        main_script_path=os.path.abspath(__file__), page_script_hash="", user_info={}))
+    return hilo
+
+class _ColaEscritura:
+    """
+    Cola durable (SQLite en modo WAL) de registros pendientes de escribir.
+
+    El formulario encola el caso con sus hechos y retorna de inmediato; un
+    hilo de fondo envia los pendientes agrupados por hoja con reintentos y
+    backoff exponencial. Estados: pendiente -> enviando -> escrito ->
+    sincronizado, o duplicado si al verificar lo escrito se descubre que otra
+    replica registro el mismo OT-TE antes (ver _descartar_duplicados). La
+    verificacion agrupa lo escrito en los ultimos COLA_VERIFICACION_SEG
+    segundos para gastar una sola lectura por hoja.
+    """
+
+    def __init__(self, ruta):
+        self.ruta   = ruta
+        self.evento = threading.Event()
+        self.ultima_verificacion = 0.0
+        self.fallos_fondo = 0
+        self.ultimo_fallo = None   # {"timestamp", "etapa", "error"} del hilo de fondo
+        with self._conexion() as con:
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS registros (
+                    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+                    hoja_casos      TEXT    NOT NULL,
+                    hoja_hechos     TEXT    NOT NULL,
+                    id_caso         INTEGER NOT NULL,
+                    max_id_hecho    INTEGER NOT NULL DEFAULT 0,
+                    ot_te           TEXT    NOT NULL,
+                    username        TEXT    NOT NULL,
+                    fila_caso       TEXT    NOT NULL,   -- JSON {columna: valor}
+                    filas_hechos    TEXT    NOT NULL,   -- JSON [{columna: valor}, ...]
+                    estado          TEXT    NOT NULL DEFAULT 'pendiente',
+                    intentos        INTEGER NOT NULL DEFAULT 0,
+                    ultimo_error    TEXT,
+                    proximo_intento REAL    NOT NULL DEFAULT 0,
+                    reclamado       REAL,
+                    creado          TEXT    NOT NULL,
+                    sincronizado    TEXT
+                )""")
+            con.execute("CREATE INDEX IF NOT EXISTS ix_registros_estado ON registros (estado, proximo_intento)")
+        self.hilo = _hilo_de_fondo(threading.Thread(target=self._bucle, name="ismr-cola-escritura",
+                                                    daemon=True))
+        self.hilo.start()
+
+    def _conexion(self):
+        con = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.row_factory = sqlite3.Row
+        return con
+
+    # ── Productor (sesiones de Streamlit) ─────────────────────────────────────
+
+    def encolar(self, hoja_casos, hoja_hechos, id_caso, ot_te, username, registro_caso, registros_hechos):
+        max_id_hecho = max((int(r["ID_Hecho"]) for r in registros_hechos), default=0)
+        # Clave de idempotencia: un reintento tras un fallo ambiguo la busca en
+        # la hoja antes de volver a escribir
+        solicitud        = uuid.uuid4().hex
+        registro_caso    = {**registro_caso, "ID_Solicitud": solicitud}
+        registros_hechos = [{**h, "ID_Solicitud": solicitud} for h in registros_hechos]
+        with self._conexion() as con:
+            con.execute(
+                "INSERT INTO registros (hoja_casos, hoja_hechos, id_caso, max_id_hecho, ot_te, username,"
+                " fila_caso, filas_hechos, creado) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (hoja_casos, hoja_hechos, id_caso, max_id_hecho, ot_te, username,
+                 json.dumps(registro_caso, ensure_ascii=False, default=str),
+                 json.dumps(registros_hechos, ensure_ascii=False, default=str),
+                 datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        self.evento.set()
+
+    def pendientes_hoja(self, nombre_hoja):
+        """OT-TE e ID maximo aun no sincronizados para una hoja."""
+        with self._conexion() as con:
+            filas = con.execute(
+                "SELECT ot_te, id_caso, max_id_hecho, hoja_casos FROM registros"
+                " WHERE estado IN ('pendiente', 'enviando') AND (hoja_casos = ? OR hoja_hechos = ?)",
+                (nombre_hoja, nombre_hoja)).fetchall()
+        ots    = {f["ot_te"] for f in filas if f["hoja_casos"] == nombre_hoja}
+        max_id = max((f["id_caso"] if f["hoja_casos"] == nombre_hoja else f["max_id_hecho"]
+                      for f in filas), default=0)
+        return ots, max_id
+
+    def estado_usuario(self, username, hoja_casos, limite=10):
+        with self._conexion() as con:
+            return [dict(f) for f in con.execute(
+                "SELECT id_caso, ot_te, estado, intentos, ultimo_error, creado, sincronizado"
+                " FROM registros WHERE username = ? AND hoja_casos = ? ORDER BY id DESC LIMIT ?",
+                (username, hoja_casos, limite))]
+
+    # ── Consumidor (hilo de fondo) ────────────────────────────────────────────
+
+    def _reclamar_lote(self):
+        con = self._conexion()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            # Lotes abandonados por un proceso que murio enviando (tambien tras
+            # un reinicio rapido, cuando aun no eran viejos al arrancar)
+            con.execute(
+                "UPDATE registros SET estado = 'pendiente', intentos = intentos + 1"
+                " WHERE estado = 'enviando' AND reclamado < ?",
+                (time.time() - COLA_RECLAMO_MAX_SEG,))
+            filas = con.execute(
+                "SELECT * FROM registros WHERE estado = 'pendiente' AND proximo_intento <= ?"
+                " ORDER BY id LIMIT ?", (time.time(), COLA_LOTE_MAX)).fetchall()
+            if filas:
+                con.executemany(
+                    "UPDATE registros SET estado = 'enviando', reclamado = ? WHERE id = ?",
+                    [(time.time(), f["id"]) for f in filas])
+            con.execute("COMMIT")
+            return [dict(f) for f in filas]
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        finally:
+            con.close()
+
+    def _enviar_grupo(self, hoja_casos, hoja_hechos, registros):
+        hoja_c, hoja_h = _hoja(hoja_casos), _hoja(hoja_hechos)
+        enc_c,  enc_h  = _asegurar_esquema(hoja_c), _asegurar_esquema(hoja_h)
+        registrar_casos_con_hechos(
+            hoja_c, hoja_h,
+            [_alinear_fila(enc_c, json.loads(r["fila_caso"])) for r in registros],
+            [_alinear_fila(enc_h, h) for r in registros for h in json.loads(r["filas_hechos"])],
+            verificar=any(r["intentos"] for r in registros))
+
+    def _verificar_escritos(self):
+        if time.time() - self.ultima_verificacion < COLA_VERIFICACION_SEG:
+            return
+        with self._conexion() as con:
+            filas = [dict(f) for f in con.execute(
+                "SELECT id, hoja_casos, hoja_hechos, ot_te, id_caso FROM registros WHERE estado = 'escrito'")]
+        if not filas:
+            return
+        self.ultima_verificacion = time.time()
+        grupos = {}
+        for r in filas:
+            grupos.setdefault((r["hoja_casos"], r["hoja_hechos"]), []).append(r)
+        for (hoja_casos, hoja_hechos), registros in grupos.items():
+            try:
+                perdedores = _descartar_duplicados(_hoja(hoja_casos), _hoja(hoja_hechos),
+                                                   [(r["ot_te"], r["id_caso"]) for r in registros])
+            except Exception as e:
+                self._anotar_fallo(f"verificacion de {hoja_casos}", e)
+                continue   # se reintenta en la proxima verificacion
+            with self._conexion() as con:
+                con.executemany(
+                    "UPDATE registros SET estado = ?, ultimo_error = ? WHERE id = ?",
+                    [("duplicado", "Otro analista registro este OT-TE al mismo tiempo; este registro se descarto", r["id"])
+                     if r["id_caso"] in perdedores else ("sincronizado", None, r["id"])
+                     for r in registros])
+            if perdedores:
+                _version_datos().incrementar()
+
+    def _procesar(self):
+        lote = self._reclamar_lote()
+        grupos = {}
+        for r in lote:
+            grupos.setdefault((r["hoja_casos"], r["hoja_hechos"]), []).append(r)
+        for (hoja_casos, hoja_hechos), registros in grupos.items():
+            ids = [r["id"] for r in registros]
+            try:
+                self._enviar_grupo(hoja_casos, hoja_hechos, registros)
+            except Exception as e:
+                with self._conexion() as con:
+                    con.executemany(
+                        "UPDATE registros SET estado = 'pendiente', intentos = intentos + 1,"
+                        " ultimo_error = ?, proximo_intento = ? WHERE id = ?",
+                        [(str(e)[:500],
+                          time.time() + min(2 ** (r["intentos"] + 1), COLA_BACKOFF_MAX_SEG),
+                          r["id"]) for r in registros])
+                continue
+            with self._conexion() as con:
+                con.executemany(
+                    "UPDATE registros SET estado = 'escrito', ultimo_error = NULL,"
+                    " sincronizado = ? WHERE id = ?",
+                    [(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), i) for i in ids])
+            _version_datos().incrementar()
+        return len(lote)
+
+    def _anotar_fallo(self, etapa, error):
+        """Errores que no quedan en ningun registro (ultimo_error): se muestran a los administradores."""
+        self.fallos_fondo += 1
+        self.ultimo_fallo = {"timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                             "etapa": etapa, "error": f"{type(error).__name__}: {error}"}
+
+    def _bucle(self):
+        while True:
+            try:
+                self._verificar_escritos()
+                if self._procesar():
+                    continue
+            except Exception as e:
+                # Fallo fuera de un envio (SQLite, lectura del lote): el hilo sigue vivo
+                self._anotar_fallo("bucle de la cola", e)
+            self.evento.wait(COLA_ESPERA_SEG)
+            self.evento.clear()
+
+@st.cache_resource
+def _cola():
+    return _ColaEscritura(COLA_DB_PATH)
+
+ICONOS_SINCRONIZACION = {"pendiente": "🕓", "enviando": "📤", "escrito": "🔎", "sincronizado": "✅", "duplicado": "⛔"}
+
+def mostrar_estado_sincronizacion(hoja_casos):
+    """Lista los ultimos registros del usuario y su estado en la cola local."""
+    registros = _cola().estado_usuario(st.session_state.username, hoja_casos)
+    if not registros:
+        return
+    pendientes = sum(r["estado"] in ("pendiente", "enviando") for r in registros)
+    with st.expander(f"🔄 Sincronización con Google Sheets ({pendientes} pendiente(s))",
+                     expanded=pendientes > 0):
+        for r in registros:
+            icono   = ICONOS_SINCRONIZACION.get(r["estado"], "•")
+            detalle = ""
+            if r["ultimo_error"]:
+                reintentos = f"{r['intentos']} reintento(s): " if r["intentos"] else ""
+                detalle = f" — {reintentos}{r['ultimo_error']}"
+            st.caption(f"{icono} ID {r['id_caso']} · {r['ot_te']} · {r['estado']} · {r['creado']}{detalle}")
+
+def mostrar_estado_cola():
+    """Fallos del hilo de fondo de la cola que no quedaron en ningun registro (sidebar admin)."""
+    cola = _cola()
+    with st.sidebar.expander(f"📤 Cola de escritura ({cola.fallos_fondo} fallo(s))"):
+        f = cola.ultimo_fallo
+        if f:
+            st.caption(f"Último fallo {f['timestamp']} en {f['etapa']}: {f['error']}")
+        else:
+            st.caption("Sin fallos en el hilo de fondo")
+
+# ══════════════════════════════════════════════════════════════════════════════
+# BORRADORES
+# ══════════════════════════════════════════════════════════════════════════════
+
+BORRADOR_DEBOUNCE_SEG    = 3          # guardados seguidos dentro de esta ventana salen en una sola escritura
+BORRADOR_BACKOFF_MAX_SEG = 300        # tope de espera entre reintentos de un vaciado en segundo plano que fallo
+BORRADORES_TTL_SEG       = 300        # relectura completa por borradores creados desde otras replicas
+BORRADOR_EXPIRACION_DIAS = 30         # borradores sin guardar en este tiempo se descartan al compactar
+COMPACTACION_PERIODO_SEG = 6 * 3600   # alineado al reloj: todas las replicas compactan en la misma frontera
+COMPACTACION_VENTANA_SEG = 120        # tras cada frontera nadie escribe borradores: las filas se estan moviendo
+COMPACTACION_ESPERA_SEG  = 15         # margen para que terminen los vaciados que empezaron antes de la frontera
+
+def _frontera_compactacion(t):
+    """Inicio del periodo de compactacion que contiene t."""
+    return t - t % COMPACTACION_PERIODO_SEG
+
+def _en_ventana_compactacion(t):
+    return t - _frontera_compactacion(t) < COMPACTACION_VENTANA_SEG
+
+def _a_tiempo_para_compactar(t):
+    """Dentro de la ventana y con COMPACTACION_ESPERA_SEG de margen antes de que las replicas relean."""
+    return COMPACTACION_ESPERA_SEG <= t - _frontera_compactacion(t) < COMPACTACION_VENTANA_SEG - COMPACTACION_ESPERA_SEG
+
+class _AlmacenBorradores:
+    """
+    Borradores indexados por (username, tipo) con su fila en la hoja, para no
+    recorrerla en cada guardado. Los guardados se acumulan BORRADOR_DEBOUNCE_SEG
+    y salen juntos (un batch_update para las filas conocidas y un append_rows
+    para las nuevas); si el JSON no cambio respecto a lo escrito no se envia
+    nada. Eliminar deja la fila con el JSON vacio en vez de borrarla: sigue
+    siendo del mismo (username, tipo) y los numeros de fila que tienen
+    indexados las demas replicas siguen siendo validos.
+
+    Las filas solo se mueven al compactar, que ocurre al inicio de cada
+    COMPACTACION_PERIODO_SEG: durante COMPACTACION_VENTANA_SEG ninguna replica
+    escribe borradores (los guardados esperan en pendientes) y al cerrarse
+    todas releen el indice.
+    """
+
+    def __init__(self):
+        self.indice     = {}     # (username, tipo) -> (fila, campos_json, hechos_json, timestamp)
+        self.pendientes = {}     # (username, tipo) -> (campos_json, hechos_json, timestamp)
+        self.cargado    = 0.0
+        self.timer      = None
+        self.ultima_compactacion = None   # {"timestamp", "filas", "bytes"}
+        self.fallos_compactacion = 0
+        self.ultimo_fallo_compactacion = None   # {"timestamp", "error"}
+        self.fallos_vaciado       = 0      # seguidos; vuelve a 0 con el primer vaciado que sale
+        self.ultimo_fallo_vaciado = None   # {"timestamp", "error"}
+        self.lock       = threading.Lock()   # indice, pendientes y timer
+        self.escritura  = threading.Lock()   # serializa lecturas completas, vaciados y compactaciones
+        self.hilo = _hilo_de_fondo(threading.Thread(target=self._bucle_compactacion,
+                                                    name="ismr-compactacion-borradores", daemon=True))
+        self.hilo.start()
+
+    def _hoja(self):
+        hoja = _hoja("Borradores", prioridad=PRIORIDAD_BORRADOR)
+        return hoja, _asegurar_esquema(hoja, prioridad=PRIORIDAD_BORRADOR)
+
+    @staticmethod
+    def _rango(encabezados, desde, hasta=None):
+        ultima = gspread.utils.rowcol_to_a1(hasta or desde, len(encabezados))
+        return f"A{desde}:{ultima}"
+
+    @staticmethod
+    def _fila(encabezados, clave, campos_json, hechos_json, timestamp):
+        return _alinear_fila(encabezados, {
+            "username": clave[0], "tipo": clave[1], "timestamp_guardado": timestamp,
+            "campos_json": campos_json, "hechos_json": hechos_json,
+        })
+
+    @staticmethod
+    def _con_contenido(borrador):
+        return bool(borrador) and bool(borrador[0] or borrador[1])
+
+    def _cargar(self, hoja):
+        datos = _api(hoja, "get_all_values", prioridad=PRIORIDAD_BORRADOR)
+        encabezados = datos[0] if datos else []
+        indice = {}
         for idx, fila in enumerate(datos[1:], start=2):
-            if len(fila) >= 2 and fila[0] == username and fila[1] == tipo:
-                hoja.update(f"A{idx}:E{idx}", [[username, tipo, timestamp, campos_json, hechos_json]])
+            reg = dict(zip(encabezados, fila))
+            if reg.get("username"):
+                # Si una carrera entre replicas dejo dos filas, gana la ultima
+                indice[(reg["username"], reg.get("tipo", ""))] = (
+                    idx, reg.get("campos_json", ""), reg.get("hechos_json", ""),
+                    reg.get("timestamp_guardado", ""))
+        with self.lock:
+            self.indice  = indice
+            self.cargado = time.time()
+
+    def _al_dia(self, ahora):
+        return (ahora - self.cargado < BORRADORES_TTL_SEG
+                and self.cargado >= _frontera_compactacion(ahora) + COMPACTACION_VENTANA_SEG)
+
+    def _vigente(self):
+        ahora = time.time()
+        # Dentro de la ventana las filas pueden estar moviendose: se usa el
+        # indice que haya (solo para leer) y se relee al cerrarse
+        if self._al_dia(ahora) or (self.cargado and _en_ventana_compactacion(ahora)):
+            return
+        with self.escritura:
+            if not self._al_dia(time.time()):
+                self._cargar(self._hoja()[0])
+
+    def invalidar(self):
+        self.cargado = 0.0
+
+    # ── Lectura ───────────────────────────────────────────────────────────────
+
+    def obtener(self, username, tipo):
+        """(campos_json, hechos_json, timestamp) del borrador, incluido uno aun sin enviar."""
+        self._vigente()
+        clave = (username, tipo)
+        with self.lock:
+            borrador = self.pendientes.get(clave) or self.indice.get(clave, (None,))[1:]
+        return tuple(borrador) if self._con_contenido(borrador) else None
+
+    # ── Escritura ─────────────────────────────────────────────────────────────
+
+    def _programar(self, demora):
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(demora, self._vaciar_en_fondo)
+                self.timer.daemon = True
+                self.timer.name   = "ismr-borradores-vaciado"
+                _hilo_de_fondo(self.timer).start()
+
+    def _pendiente(self, clave, campos_json, hechos_json):
+        """Deja el borrador para el proximo vaciado; False si es igual a lo ya guardado."""
+        with self.lock:
+            actual = self.pendientes.get(clave) or self.indice.get(clave, (None,))[1:]
+            if tuple(actual[:2]) == (campos_json, hechos_json):
+                return False
+            self.pendientes[clave] = (campos_json, hechos_json,
+                                      datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            return True
+
+    def guardar(self, username, tipo, campos, hechos, inmediato=False):
+        """Retorna False si un guardado inmediato quedo diferido (sigue en pendientes)."""
+        self._vigente()
+        clave = (username, tipo)
+        cambio = self._pendiente(clave, json.dumps(campos, ensure_ascii=False),
+                                 json.dumps(hechos, ensure_ascii=False))
+        if inmediato and (cambio or clave in self.pendientes):
+            return self.vaciar()
+        if cambio:
+            self._programar(BORRADOR_DEBOUNCE_SEG)
+        return True
+
+    def eliminar(self, username, tipo):
+        self._vigente()
+        clave = (username, tipo)
+        with self.lock:
+            if not self._con_contenido(self.indice.get(clave, (None,))[1:]):
+                # Nunca llego a la hoja (o ya estaba vacio): basta con olvidarlo
+                self.pendientes.pop(clave, None)
+                return
+        self._pendiente(clave, "", "")
+        self.vaciar()
+
+    def _vaciar_en_fondo(self):
+        with self.lock:
+            self.timer = None
+        try:
+            self.vaciar()
+        except Exception as e:
+            # Lo no enviado sigue en pendientes: se reintenta con backoff y queda a la vista
+            self.fallos_vaciado += 1
+            self.ultimo_fallo_vaciado = {"timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                         "error": f"{type(e).__name__}: {e}"}
+            self._programar(min(BORRADOR_DEBOUNCE_SEG * 2 ** self.fallos_vaciado, BORRADOR_BACKOFF_MAX_SEG))
+        else:
+            self.fallos_vaciado = 0
+
+    def _enviable(self):
+        """
+        Si ya empezo la ventana de compactacion lanza CuotaDiferida. Se
+        comprueba justo antes de cada envio, que sale con bloquear=False: un
+        vaciado que esperara turno en el planificador podria llegar a la hoja
+        despues de COMPACTACION_ESPERA_SEG, con las filas ya movidas.
+        """
+        if _en_ventana_compactacion(time.time()):
+            raise CuotaDiferida("borradores diferidos por la compactacion")
+
+    def vaciar(self):
+        """
+        Envia los guardados acumulados: un batch_update y, si hay nuevos, un
+        append_rows. Si la compactacion o la cuota lo difieren, el lote vuelve
+        a pendientes, se reprograma y retorna False.
+        """
+        ahora = time.time()
+        if _en_ventana_compactacion(ahora):
+            self._programar(_frontera_compactacion(ahora) + COMPACTACION_VENTANA_SEG - ahora + 1)
+            return False
+        self._vigente()
+        with self.escritura:
+            with self.lock:
+                lote, self.pendientes = self.pendientes, {}
+                filas = {clave: self.indice[clave][0] for clave in lote if clave in self.indice}
+            nuevas = [clave for clave in lote if clave not in filas and self._con_contenido(lote[clave])]
+            if not (filas or nuevas):
                 return True
-        hoja.append_row([username, tipo, timestamp, campos_json, hechos_json])
+            try:
+                hoja, encabezados = self._hoja()
+                if filas:
+                    self._enviable()
+                    _api(hoja, "batch_update", [
+                        {"range": self._rango(encabezados, fila),
+                         "values": [self._fila(encabezados, clave, *lote[clave])]}
+                        for clave, fila in filas.items()
+                    ], prioridad=PRIORIDAD_BORRADOR, bloquear=False)
+                if nuevas:
+                    self._enviable()
+                    respuesta = _api(hoja, "append_rows",
+                                     [self._fila(encabezados, clave, *lote[clave]) for clave in nuevas],
+                                     prioridad=PRIORIDAD_BORRADOR, bloquear=False)
+                    primera, _ = _filas_append(respuesta)
+                    filas.update({clave: primera + i for i, clave in enumerate(nuevas)})
+            except Exception as e:
+                with self.lock:
+                    for clave, valor in lote.items():
+                        self.pendientes.setdefault(clave, valor)
+                if not isinstance(e, CuotaDiferida):
+                    raise
+                ahora = time.time()
+                if _en_ventana_compactacion(ahora):
+                    self._programar(_frontera_compactacion(ahora) + COMPACTACION_VENTANA_SEG - ahora + 1)
+                else:
+                    self._programar(BORRADOR_DEBOUNCE_SEG)
+                return False
+            with self.lock:
+                for clave, fila in filas.items():
+                    self.indice[clave] = (fila, *lote[clave])
+            return True
+
+    # ── Compactacion ──────────────────────────────────────────────────────────
+
+    def _bucle_compactacion(self):
+        while True:
+            ahora  = time.time()
+            inicio = _frontera_compactacion(ahora) + COMPACTACION_PERIODO_SEG + COMPACTACION_ESPERA_SEG
+            time.sleep(max(inicio - ahora, 0))
+            try:
+                self.compactar()
+            except Exception as e:
+                # Se intenta de nuevo en la proxima frontera; mientras, a la vista de los administradores
+                self.fallos_compactacion += 1
+                self.ultimo_fallo_compactacion = {"timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                                  "error": f"{type(e).__name__}: {e}"}
+
+    def _compactable(self):
+        """
+        Lanza CuotaDiferida si la escritura ya no alcanzaria a llegar antes de
+        que se cierre la ventana: pasada la ventana las demas replicas releen
+        el indice y una escritura tardia dejaria sus numeros de fila viejos.
+        Cada peticion sale con bloquear=False por la misma razon.
+        """
+        if not _a_tiempo_para_compactar(time.time()):
+            raise CuotaDiferida("compactacion fuera de la ventana; se intenta en la proxima")
+
+    def compactar(self):
+        """
+        Descarta los borradores vacios, repetidos o sin guardar hace mas de
+        BORRADOR_EXPIRACION_DIAS, reescribe los vivos desde la fila 2 en un solo
+        update y limpia la cola que queda libre. Todas las replicas leen lo
+        mismo dentro de la ventana, asi que si varias compactan a la vez
+        escriben el mismo resultado.
+        """
+        limite = (datetime.now() - timedelta(days=BORRADOR_EXPIRACION_DIAS)).strftime("%Y-%m-%d %H:%M:%S")
+        with self.escritura:
+            hoja, _ = self._hoja()
+            self._compactable()
+            datos = _api(hoja, "get_all_values", prioridad=PRIORIDAD_BORRADOR, bloquear=False)
+            encabezados, filas = (datos[0], datos[1:]) if datos else ([], [])
+            vivos = {}
+            for fila in filas:
+                reg = dict(zip(encabezados, fila))
+                if (reg.get("username") and (reg.get("campos_json") or reg.get("hechos_json"))
+                        and reg.get("timestamp_guardado", "") >= limite):
+                    vivos[(reg["username"], reg.get("tipo", ""))] = _alinear_fila(encabezados, reg)
+            tamano = lambda filas: sum(len(celda.encode("utf-8")) for fila in filas for celda in fila)
+            reclamadas = len(filas) - len(vivos)
+            if reclamadas:
+                nuevas = list(vivos.values())
+                if nuevas:
+                    self._compactable()
+                    _api(hoja, "update", self._rango(encabezados, 2, len(nuevas) + 1), nuevas,
+                         prioridad=PRIORIDAD_BORRADOR, bloquear=False)
+                # Si el vaciado de la cola no alcanza queda cada vivo dos veces; al releer
+                # gana la ultima aparicion, que tiene el mismo contenido
+                self._compactable()
+                _api(hoja, "batch_clear", [self._rango(encabezados, len(nuevas) + 2, len(filas) + 1)],
+                     prioridad=PRIORIDAD_BORRADOR, bloquear=False)
+                col = {nombre: encabezados.index(nombre)
+                       for nombre in ("campos_json", "hechos_json", "timestamp_guardado")}
+                with self.lock:
+                    self.indice = {
+                        clave: (idx, fila[col["campos_json"]], fila[col["hechos_json"]],
+                                fila[col["timestamp_guardado"]])
+                        for idx, (clave, fila) in enumerate(vivos.items(), start=2)
+                    }
+                    self.cargado = time.time()
+            self.ultima_compactacion = {
+                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "filas": reclamadas,
+                "bytes": tamano(filas) - tamano(vivos.values()),
+            }
+            return self.ultima_compactacion
+
+@st.cache_resource
+def _almacen_borradores():
+    return _AlmacenBorradores()
+
+def guardar_borrador(tipo, campos, hechos, inmediato=False):
+    """
+    Guarda el borrador del usuario. Por defecto se difiere BORRADOR_DEBOUNCE_SEG
+    para juntar guardados seguidos (p.ej. al agregar varios hechos); con
+    inmediato=True se envia antes de retornar y retorna False si no se pudo
+    (error, o diferido por cuota o por la compactacion: sale solo despues).
+    """
+    try:
+        almacen = _almacen_borradores()
+        if not almacen.guardar(st.session_state.username, tipo, campos, hechos, inmediato):
+            st.warning("⏳ El borrador aún no se guardó en Google Sheets (cuota o mantenimiento de la hoja); "
+                       "queda pendiente y se enviará automáticamente.")
+            return False
+        if almacen.fallos_vaciado and any(u == st.session_state.username for u, _ in almacen.pendientes):
+            st.warning(f"⚠️ El guardado automático del borrador está fallando y se reintenta "
+                       f"({almacen.ultimo_fallo_vaciado['error']})")
         return True
     except Exception as e:
+        _pool_hojas().invalidar()
         st.error(f"Error al guardar borrador: {e}")
         return False
 
 def cargar_borrador(tipo):
-    import json
-    hoja = _conectar_hoja_borradores()
-    if not hoja:
-        return None, None, None
     try:
-        username = st.session_state.username
-        for fila in hoja.get_all_values()[1:]:
-            if len(fila) >= 5 and fila[0] == username and fila[1] == tipo:
-                campos = json.loads(fila[3]) if fila[3] else {}
-                hechos = json.loads(fila[4]) if fila[4] else []
-                return campos, hechos, fila[2]
-        return None, None, None
+        borrador = _almacen_borradores().obtener(st.session_state.username, tipo)
+        if not borrador:
+            return None, None, None
+        campos_json, hechos_json, timestamp = borrador
+        campos = json.loads(campos_json) if campos_json else {}
+        hechos = json.loads(hechos_json) if hechos_json else []
+        return campos, hechos, timestamp
     except Exception as e:
+        _pool_hojas().invalidar()
         st.error(f"Error al cargar borrador: {e}")
         return None, None, None
 
 def eliminar_borrador(tipo):
-    hoja = _conectar_hoja_borradores()
-    if not hoja:
-        return
     try:
-        username = st.session_state.username
-        datos = hoja.get_all_values()
-        for idx, fila in enumerate(datos[1:], start=2):
-            if len(fila) >= 2 and fila[0] == username and fila[1] == tipo:
-                hoja.delete_rows(idx)
-                return
+        _almacen_borradores().eliminar(st.session_state.username, tipo)
     except Exception as e:
+        _pool_hojas().invalidar()
         st.error(f"Error al eliminar borrador: {e}")
 
+def mostrar_estado_borradores():
+    """Resultado de la ultima compactacion de Borradores y hora de la proxima (sidebar admin)."""
+    almacen = _almacen_borradores()
+    proxima = datetime.fromtimestamp(_frontera_compactacion(time.time()) + COMPACTACION_PERIODO_SEG
+                                     + COMPACTACION_ESPERA_SEG)
+    with st.sidebar.expander("🗂️ Borradores"):
+        st.caption(f"Borradores indexados: {sum(almacen._con_contenido(e[1:]) for e in almacen.indice.values())}"
+                   f" · pendientes de envío: {len(almacen.pendientes)}")
+        c = almacen.ultima_compactacion
+        if c:
+            st.caption(f"Última compactación {c['timestamp']}: {c['filas']} fila(s), {c['bytes'] / 1024:.1f} KB liberados")
+        f = almacen.ultimo_fallo_vaciado
+        if f:
+            st.caption(f"Vaciado en segundo plano: {almacen.fallos_vaciado} fallo(s) seguidos · "
+                       f"último {f['timestamp']}: {f['error']}")
+        f = almacen.ultimo_fallo_compactacion
+        if f:
+            st.caption(f"Compactaciones fallidas: {almacen.fallos_compactacion} · "
+                       f"última {f['timestamp']}: {f['error']}")
+        st.caption(f"Próxima compactación: {proxima:%Y-%m-%d %H:%M}")
+
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -503,10 +2624,8 @@ def pantalla_selector():
 # ══════════════════════════════════════════════════════════════════════════════
 
 def formulario_individual():
-    hoja_casos, hoja_hechos, sheet_url = conectar_sheets_individual()
-    if hoja_casos is None:
-        st.error("⚠️ No se pudo conectar a Google Sheets")
-        return
+    # Las hojas se resuelven solo al registrar: cada tecla en un campo provoca
+    # un rerun y el formulario debe dibujarse sin ninguna llamada a la API.
 
     # ── Cargar borrador si existe (solo la primera vez en esta sesión) ─────────
     if not st.session_state.get("_borrador_ind_revisado"):
@@ -565,15 +2684,15 @@ def formulario_individual():
     col1, col2 = st.columns(2)
     with col1:
         edad         = st.number_input("Edad *", min_value=0, max_value=120, value=None, key="ind_edad")
-        sexo         = st.selectbox("Sexo *", ["Seleccione...", "Hombre", "Mujer", "Otro", "No Reporta"], key="ind_sexo")
+        sexo         = st.selectbox("Sexo *", SEXOS, key="ind_sexo")
         departamento = st.text_input("Departamento *", placeholder="Ejemplo: Antioquia", key="ind_depto")
-        año          = st.number_input("Año OT *", min_value=2000, max_value=2026, value=None, key="ind_anio")
+        año          = st.number_input("Año OT *", min_value=AÑO_OT_MIN, max_value=AÑO_OT_MAX, value=None, key="ind_anio")
         mes          = st.number_input("Mes OT *", min_value=1, max_value=12, value=None, key="ind_mes")
     with col2:
         municipio    = st.text_input("Municipio *", placeholder="Ejemplo: Medellín", key="ind_muni")
-        solicitante  = st.selectbox("Entidad Solicitante *", ["Seleccione...", "ARN", "SESP", "OTRO"], key="ind_sol")
-        tipo_estudio = st.selectbox("Tipo de Estudio *", ["Seleccione...", "ORDEN DE TRABAJO OT", "TRÁMITE DE EMERGENCIA TE"], key="ind_tipo_estudio")
-        nivel_riesgo = st.selectbox("Nivel de Riesgo *", ["Seleccione...", "EXTRAORDINARIO", "EXTREMO", "ORDINARIO"], key="ind_riesgo")
+        solicitante  = st.selectbox("Entidad Solicitante *", SOLICITANTES, key="ind_sol")
+        tipo_estudio = st.selectbox("Tipo de Estudio *", TIPOS_ESTUDIO, key="ind_tipo_estudio")
+        nivel_riesgo = st.selectbox("Nivel de Riesgo *", NIVELES_RIESGO, key="ind_riesgo")
 
     observaciones = st.text_area("Observaciones (Opcional)", height=80, key="ind_obs")
 
@@ -603,21 +2722,16 @@ def formulario_individual():
         with st.form("form_hecho_individual", clear_on_submit=True):
             c1, c2 = st.columns(2)
             with c1:
-                tipo_hecho  = st.selectbox("Tipo de Hecho *", [
-                    "Seleccione...", "Amenaza", "Atentado", "Desplazamiento forzado",
-                    "Homicidio", "Secuestro", "Extorsión", "Reclutamiento forzado",
-                    "Violencia sexual", "Confinamiento", "Otro"])
+                tipo_hecho  = st.selectbox("Tipo de Hecho *", TIPOS_HECHO)
                 fecha_hecho = st.date_input("Fecha del Hecho *")
                 lugar_hecho = st.text_input("Lugar donde ocurrió *", placeholder="Municipio, vereda, barrio...")
             with c2:
                 autor_hecho       = st.text_input("Autor *", placeholder="Grupo armado, persona, etc.")
                 descripcion_hecho = st.text_area("Descripción *", placeholder="Describe brevemente el hecho...", height=122)
             if st.form_submit_button("➕ Agregar este hecho", use_container_width=True):
-                err_h = []
-                if tipo_hecho == "Seleccione...": err_h.append("Selecciona el tipo de hecho")
-                if not lugar_hecho.strip():        err_h.append("El lugar es obligatorio")
-                if not autor_hecho.strip():        err_h.append("El autor es obligatorio")
-                if not descripcion_hecho.strip():  err_h.append("La descripción es obligatoria")
+                err_h = VALIDADORES["Hecho"].fila({
+                    "Tipo de Hecho": tipo_hecho, "Fecha del Hecho": fecha_hecho, "Lugar": lugar_hecho,
+                    "Autor": autor_hecho, "Descripcion": descripcion_hecho})
                 if err_h:
                     for e in err_h: st.error(f"• {e}")
                 else:
@@ -650,58 +2764,58 @@ def formulario_individual():
                 "ind_sol": solicitante, "ind_riesgo": nivel_riesgo,
                 "ind_tipo_estudio": tipo_estudio, "ind_anio": año,
                 "ind_mes": mes, "ind_obs": observaciones
-            }, st.session_state.hechos_individual)
+            }, st.session_state.hechos_individual, inmediato=True)
             if ok:
                 st.success("💾 Borrador guardado. Puedes retomarlo luego.")
     with col_register:
         registrar = st.button("✅ REGISTRAR CASO INDIVIDUAL", use_container_width=True, type="primary")
 
     if registrar:
-        errores = []
-        if not ot_te or not ot_te.strip():               errores.append("El campo OT-TE es obligatorio")
-        if edad is None or edad == 0:                    errores.append("La edad es obligatoria")
-        if sexo == "Seleccione...":                      errores.append("Debe seleccionar un sexo")
-        if not departamento or not departamento.strip(): errores.append("El departamento es obligatorio")
-        if not municipio or not municipio.strip():       errores.append("El municipio es obligatorio")
-        if solicitante == "Seleccione...":               errores.append("Debe seleccionar una entidad solicitante")
-        if nivel_riesgo == "Seleccione...":              errores.append("Debe seleccionar un nivel de riesgo")
-        if tipo_estudio == "Seleccione...":              errores.append("Debe seleccionar un tipo de estudio")
-        if año is None:                                  errores.append("El año es obligatorio")
-        if mes is None:                                  errores.append("El mes es obligatorio")
+        errores = VALIDADORES["Individual"].fila({
+            "OT-TE": ot_te, "Edad": edad, "Sexo": sexo, "Departamento": departamento,
+            "Municipio": municipio, "Solicitante": solicitante, "Nivel de Riesgo": nivel_riesgo,
+            "Tipo de Estudio": tipo_estudio, "Año OT": año, "Mes OT": mes,
+        })
 
         if errores:
             st.error("❌ Por favor corrija los siguientes errores:")
             for e in errores: st.write(f"   • {e}")
         else:
+            reclamado = None
             try:
-                todas_filas   = hoja_casos.get_all_values()
-                ot_existentes = [fila[1] for fila in todas_filas[1:]]
-                if ot_te.strip() in ot_existentes:
+                hoja_casos, hoja_hechos, _ = conectar_sheets_individual()
+                if hoja_casos is None:
+                    raise Exception("No se pudo conectar a Google Sheets")
+                indice_casos = _indice(hoja_casos)
+                if not indice_casos.reclamar_ot(ot_te):
                     st.error(f"❌ El caso '{ot_te}' ya existe en la hoja Individual")
                 else:
+                    reclamado = indice_casos
                     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                     id_caso   = obtener_siguiente_id(hoja_casos)
-                    hoja_casos.append_row([
-                        timestamp, ot_te.strip(), edad, sexo,
-                        departamento.strip(), municipio.strip(), solicitante, nivel_riesgo,
-                        observaciones.strip() if observaciones else "",
-                        st.session_state.nombre_completo, st.session_state.username, id_caso,
-                        tipo_estudio, año, mes
-                    ])
-                    hechos_guardados = 0
-                    for hecho in st.session_state.hechos_individual:
-                        id_hecho = obtener_siguiente_id(hoja_hechos)
-                        hoja_hechos.append_row([
-                            id_hecho, id_caso, ot_te.strip(),
-                            hecho["tipo"], hecho["fecha"], hecho["lugar"],
-                            hecho["autor"], hecho["descripcion"],
-                            st.session_state.nombre_completo, st.session_state.username
-                        ])
-                        hechos_guardados += 1
+                    hechos    = st.session_state.hechos_individual
+                    ids_hecho = _indice(hoja_hechos).reservar_ids(len(hechos))
+                    registro_caso = {
+                        "Timestamp": timestamp, "OT-TE": ot_te.strip(), "Edad": edad, "Sexo": sexo,
+                        "Departamento": departamento.strip(), "Municipio": municipio.strip(),
+                        "Solicitante": solicitante, "Nivel de Riesgo": nivel_riesgo,
+                        "Observaciones": observaciones.strip() if observaciones else "",
+                        "Analista": st.session_state.nombre_completo,
+                        "Usuario Analista": st.session_state.username, "ID_Caso": id_caso,
+                        "Tipo de Estudio": tipo_estudio, "Año OT": año, "Mes OT": mes,
+                    }
+                    registros_hechos = _registros_hechos(ids_hecho, id_caso, ot_te.strip(), hechos)
+                    _cola().encolar(hoja_casos.title, hoja_hechos.title, id_caso, ot_te.strip(),
+                                    st.session_state.username, registro_caso, registros_hechos)
+                    indice_casos.confirmar_ot(ot_te)
+                    reclamado = None
+                    _version_datos().incrementar()
+                    hechos_guardados = len(hechos)
                     eliminar_borrador("individual")
                     st.session_state.hechos_individual = []
                     st.session_state.pop("_borrador_ind_revisado", None)
-                    st.success(f"✅ Caso **{ot_te}** registrado como Individual!")
+                    st.success(f"✅ Caso **{ot_te}** registrado como Individual! "
+                               "Se está sincronizando con Google Sheets en segundo plano.")
                     if hechos_guardados > 0:
                         st.info(f"⚠️ {hechos_guardados} hecho(s) de riesgo registrados")
                     st.balloons()
@@ -717,8 +2831,12 @@ def formulario_individual():
                     - **Fecha:** {timestamp}
                     """)
             except Exception as e:
+                if reclamado is not None:
+                    reclamado.liberar_ot(ot_te)   # no quedo encolado: el OT-TE sigue libre
                 st.error(f"❌ Error al guardar: {e}")
 
+    mostrar_estado_sincronizacion("Individual")
+    mostrar_traza_rerun()
     st.markdown("---")
     st.caption("🔒 Los datos se guardan en la hoja 'Individual' de Google Sheets")
 
@@ -727,26 +2845,9 @@ def formulario_individual():
 # FORMULARIO COLECTIVO
 # ══════════════════════════════════════════════════════════════════════════════
 
-SECTORES_COLECTIVO = [
-    "Seleccione...",
-    "Comunidad campesina",
-    "Comunidad indígena",
-    "Comunidad afrodescendiente",
-    "Organización social",
-    "Organización sindical",
-    "Organización de mujeres",
-    "Organización de jóvenes",
-    "Organización LGBTIQ+",
-    "Defensores de DDHH",
-    "Líderes sociales",
-    "Otro",
-]
-
 def formulario_colectivo():
-    hoja_casos, hoja_hechos, sheet_url = conectar_sheets_colectivo()
-    if hoja_casos is None:
-        st.error("⚠️ No se pudo conectar a Google Sheets")
-        return
+    # Las hojas se resuelven solo al registrar: cada tecla en un campo provoca
+    # un rerun y el formulario debe dibujarse sin ninguna llamada a la API.
 
     # ── Cargar borrador si existe (solo la primera vez en esta sesión) ─────────
     if not st.session_state.get("_borrador_col_revisado"):
@@ -841,21 +2942,16 @@ def formulario_colectivo():
         with st.form("form_hecho_colectivo", clear_on_submit=True):
             c1, c2 = st.columns(2)
             with c1:
-                tipo_hecho  = st.selectbox("Tipo de Hecho *", [
-                    "Seleccione...", "Amenaza", "Atentado", "Desplazamiento forzado",
-                    "Homicidio", "Secuestro", "Extorsión", "Reclutamiento forzado",
-                    "Violencia sexual", "Confinamiento", "Otro"])
+                tipo_hecho  = st.selectbox("Tipo de Hecho *", TIPOS_HECHO)
                 fecha_hecho = st.date_input("Fecha del Hecho *")
                 lugar_hecho = st.text_input("Lugar donde ocurrió *", placeholder="Municipio, vereda, barrio...")
             with c2:
                 autor_hecho       = st.text_input("Autor *", placeholder="Grupo armado, persona, etc.")
                 descripcion_hecho = st.text_area("Descripción *", placeholder="Describe brevemente el hecho...", height=122)
             if st.form_submit_button("➕ Agregar este hecho", use_container_width=True):
-                err_h = []
-                if tipo_hecho == "Seleccione...": err_h.append("Selecciona el tipo de hecho")
-                if not lugar_hecho.strip():        err_h.append("El lugar es obligatorio")
-                if not autor_hecho.strip():        err_h.append("El autor es obligatorio")
-                if not descripcion_hecho.strip():  err_h.append("La descripción es obligatoria")
+                err_h = VALIDADORES["Hecho"].fila({
+                    "Tipo de Hecho": tipo_hecho, "Fecha del Hecho": fecha_hecho, "Lugar": lugar_hecho,
+                    "Autor": autor_hecho, "Descripcion": descripcion_hecho})
                 if err_h:
                     for e in err_h: st.error(f"• {e}")
                 else:
@@ -884,51 +2980,56 @@ def formulario_colectivo():
                 "col_ot": ot_te, "col_nombre": nombre_colectivo,
                 "col_sector": sector, "col_depto": departamento,
                 "col_muni": municipio
-            }, st.session_state.hechos_colectivo)
+            }, st.session_state.hechos_colectivo, inmediato=True)
             if ok:
                 st.success("💾 Borrador guardado. Puedes retomarlo luego.")
     with col_register:
         registrar = st.button("✅ REGISTRAR CASO COLECTIVO", use_container_width=True, type="primary")
 
     if registrar:
-        errores = []
-        if not ot_te or not ot_te.strip():                       errores.append("El campo OT-TE es obligatorio")
-        if not nombre_colectivo or not nombre_colectivo.strip(): errores.append("El nombre del colectivo es obligatorio")
-        if sector == "Seleccione...":                            errores.append("Debe seleccionar un sector")
-        if not departamento or not departamento.strip():         errores.append("El departamento es obligatorio")
-        if not municipio or not municipio.strip():               errores.append("El municipio es obligatorio")
+        errores = VALIDADORES["Colectivo"].fila({
+            "OT-TE": ot_te, "Nombre Colectivo": nombre_colectivo, "Fecha Creacion Colectivo": fecha_creacion,
+            "Sector": sector, "Departamento": departamento, "Municipio": municipio,
+        })
 
         if errores:
             st.error("❌ Por favor corrija los siguientes errores:")
             for e in errores: st.write(f"   • {e}")
         else:
+            reclamado = None
             try:
-                todas_filas   = hoja_casos.get_all_values()
-                ot_existentes = [fila[1] for fila in todas_filas[1:]]
-                if ot_te.strip() in ot_existentes:
+                hoja_casos, hoja_hechos, _ = conectar_sheets_colectivo()
+                if hoja_casos is None:
+                    raise Exception("No se pudo conectar a Google Sheets")
+                indice_casos = _indice(hoja_casos)
+                if not indice_casos.reclamar_ot(ot_te):
                     st.error(f"❌ El caso '{ot_te}' ya existe en la hoja Colectivo")
                 else:
+                    reclamado = indice_casos
                     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                     id_caso   = obtener_siguiente_id(hoja_casos)
-                    hoja_casos.append_row([
-                        timestamp, ot_te.strip(), nombre_colectivo.strip(),
-                        str(fecha_creacion), sector, departamento.strip(), municipio.strip(),
-                        st.session_state.nombre_completo, st.session_state.username, id_caso
-                    ])
-                    hechos_guardados = 0
-                    for hecho in st.session_state.hechos_colectivo:
-                        id_hecho = obtener_siguiente_id(hoja_hechos)
-                        hoja_hechos.append_row([
-                            id_hecho, id_caso, ot_te.strip(),
-                            hecho["tipo"], hecho["fecha"], hecho["lugar"],
-                            hecho["autor"], hecho["descripcion"],
-                            st.session_state.nombre_completo, st.session_state.username
-                        ])
-                        hechos_guardados += 1
+                    hechos    = st.session_state.hechos_colectivo
+                    ids_hecho = _indice(hoja_hechos).reservar_ids(len(hechos))
+                    registro_caso = {
+                        "Timestamp": timestamp, "OT-TE": ot_te.strip(),
+                        "Nombre Colectivo": nombre_colectivo.strip(),
+                        "Fecha Creacion Colectivo": str(fecha_creacion), "Sector": sector,
+                        "Departamento": departamento.strip(), "Municipio": municipio.strip(),
+                        "Analista": st.session_state.nombre_completo,
+                        "Usuario Analista": st.session_state.username, "ID_Caso": id_caso,
+                    }
+                    registros_hechos = _registros_hechos(ids_hecho, id_caso, ot_te.strip(), hechos)
+                    _cola().encolar(hoja_casos.title, hoja_hechos.title, id_caso, ot_te.strip(),
+                                    st.session_state.username, registro_caso, registros_hechos)
+                    indice_casos.confirmar_ot(ot_te)
+                    reclamado = None
+                    _version_datos().incrementar()
+                    hechos_guardados = len(hechos)
                     eliminar_borrador("colectivo")
                     st.session_state.hechos_colectivo = []
                     st.session_state.pop("_borrador_col_revisado", None)
-                    st.success(f"✅ Caso **{ot_te}** registrado como Colectivo!")
+                    st.success(f"✅ Caso **{ot_te}** registrado como Colectivo! "
+                               "Se está sincronizando con Google Sheets en segundo plano.")
                     if hechos_guardados > 0:
                         st.info(f"⚠️ {hechos_guardados} hecho(s) de riesgo registrados")
                     st.balloons()
@@ -945,147 +3046,616 @@ def formulario_colectivo():
                     - **Fecha registro:** {timestamp}
                     """)
             except Exception as e:
+                if reclamado is not None:
+                    reclamado.liberar_ot(ot_te)   # no quedo encolado: el OT-TE sigue libre
                 st.error(f"❌ Error al guardar: {e}")
 
+    mostrar_estado_sincronizacion("Colectivo")
+    mostrar_traza_rerun()
     st.markdown("---")
     st.caption("🔒 Los datos se guardan en la hoja 'Colectivo' de Google Sheets")
 
 
+# ══════════════════════════════════════════════════════════════════════════════
+# EXPORTACIÓN
+# ══════════════════════════════════════════════════════════════════════════════
+
+EXPORT_BLOQUE_FILAS = 5000
+
+# formato -> (extension, mime, modulo opcional que lo habilita)
+FORMATOS_EXPORTACION = {
+    "CSV":     ("csv",     "text/csv", None),
+    "Parquet": ("parquet", "application/vnd.apache.parquet", "pyarrow"),
+    "Excel":   ("xlsx",    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "openpyxl"),
+}
+
+def _formatos_disponibles():
+    return [f for f, (_, _, modulo) in FORMATOS_EXPORTACION.items()
+            if modulo is None or importlib.util.find_spec(modulo) is not None]
+
+def _bloques(df):
+    """Recorre df en bloques de EXPORT_BLOQUE_FILAS filas (vistas, sin copiar el total)."""
+    for inicio in range(0, len(df), EXPORT_BLOQUE_FILAS):
+        yield df.iloc[inicio:inicio + EXPORT_BLOQUE_FILAS]
+
+def _exportacion(casos, hechos=None):
+    """
+    (plantilla, bloques): un DataFrame vacio con las columnas y dtypes del
+    total, y el generador de bloques. Con hechos, cada caso unido a sus
+    hechos (uno por fila, por ID_Caso).
+    """
+    if hechos is None or "ID_Caso" not in casos.columns or "ID_Caso" not in hechos.columns:
+        return casos.head(0), _bloques(casos)
+    # Columnas que ya vienen del caso (OT-TE, Analista...) no se repiten
+    hechos = hechos[["ID_Caso"] + [c for c in hechos.columns if c not in casos.columns]]
+    plantilla = casos.head(0).merge(hechos.head(0), on="ID_Caso", how="left")
+    # La union de marcos vacios no conserva el orden de columnas de la de los bloques
+    plantilla = plantilla[list(casos.columns) + list(hechos.columns[1:])]
+    return plantilla, _bloques_unidos(casos, hechos)
+
+def _bloques_unidos(casos, hechos):
+    for bloque in _bloques(casos):
+        yield bloque.merge(hechos[hechos["ID_Caso"].isin(bloque["ID_Caso"])], on="ID_Caso", how="left")
+
+def _escribir_csv(plantilla, bloques, ruta):
+    with open(ruta, "w", encoding="utf-8-sig", newline="") as f:
+        plantilla.to_csv(f, index=False)
+        for bloque in bloques:
+            bloque.to_csv(f, header=False, index=False)
+
+def _esquema_parquet(plantilla):
+    """
+    Esquema de Arrow tomado de los dtypes del total y no del primer bloque:
+    en un bloque sin hechos las columnas object vienen todas en NaN y Arrow
+    las inferiria como null. Las columnas object van siempre como texto.
+    """
+    import pyarrow as pa
+    esquema = pa.Schema.from_pandas(plantilla, preserve_index=False)
+    for i, campo in enumerate(esquema):
+        if plantilla[campo.name].dtype == object:
+            esquema = esquema.set(i, pa.field(campo.name, pa.string()))
+    return esquema
+
+def _escribir_parquet(plantilla, bloques, ruta):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    esquema = _esquema_parquet(plantilla)
+    with pq.ParquetWriter(ruta, esquema) as escritor:
+        for bloque in bloques:   # un row group por bloque
+            escritor.write_table(pa.Table.from_pandas(bloque, schema=esquema, preserve_index=False))
+
+def _escribir_xlsx(plantilla, bloques, ruta):
+    from openpyxl import Workbook
+    libro = Workbook(write_only=True)
+    hoja  = libro.create_sheet("Datos")
+    hoja.append(list(plantilla.columns))
+    for bloque in bloques:
+        for fila in bloque.astype(object).where(bloque.notna(), None).itertuples(index=False):
+            hoja.append(list(fila))
+    libro.save(ruta)
+
+ESCRITORES_EXPORTACION = {"CSV": _escribir_csv, "Parquet": _escribir_parquet, "Excel": _escribir_xlsx}
+
+EXPORT_CARPETA      = os.path.join(tempfile.gettempdir(), "ismr_exportaciones")
+EXPORT_ARCHIVO_SEG  = 3600   # archivos generados mas viejos se borran al generar otro
+
+def _limpiar_exportaciones():
+    ahora = time.time()
+    for nombre in os.listdir(EXPORT_CARPETA):
+        ruta = os.path.join(EXPORT_CARPETA, nombre)
+        try:
+            if ahora - os.path.getmtime(ruta) > EXPORT_ARCHIVO_SEG:
+                os.remove(ruta)
+        except OSError:
+            pass   # otra sesion lo borro primero
+
+def _descarga_diferida(df, etiqueta, nombre_base, key, firma, hechos=None):
+    """
+    Exportacion bajo demanda: nada se genera hasta que el usuario lo pide.
+    El archivo se escribe bloque a bloque en disco, asi que la memoria de
+    trabajo depende del tamano del bloque y no del total de filas. Con
+    hechos se exporta cada caso unido a sus hechos.
+
+    Se genera una sola vez y la ruta queda en la sesion junto al formato y
+    la firma (revision de los datos y filtros); si alguno cambia hay que generarlo
+    de nuevo.
+    """
+    c1, c2 = st.columns([1, 3])
+    with c1:
+        formato = st.selectbox("Formato", _formatos_disponibles(), key=f"{key}_formato",
+                               label_visibility="collapsed")
+    extension, mime, _ = FORMATOS_EXPORTACION[formato]
+    listo = st.session_state.get(f"{key}_listo")   # ((formato, firma), ruta)
+    if listo and (listo[0] != (formato, firma) or not os.path.exists(listo[1])):
+        try:
+            os.remove(listo[1])
+        except OSError:
+            pass
+        listo = st.session_state[f"{key}_listo"] = None
+    with c2:
+        if listo is None:
+            if st.button(etiqueta.replace("📥 Descargar", "📦 Generar"), key=f"{key}_preparar"):
+                os.makedirs(EXPORT_CARPETA, exist_ok=True)
+                _limpiar_exportaciones()
+                descriptor, ruta = tempfile.mkstemp(suffix=f".{extension}", dir=EXPORT_CARPETA)
+                os.close(descriptor)
+                plantilla, bloques = _exportacion(df, hechos)
+                ESCRITORES_EXPORTACION[formato](plantilla, bloques, ruta)
+                st.session_state[f"{key}_listo"] = ((formato, firma), ruta)
+                st.rerun()
+            return
+        with open(listo[1], "rb") as archivo:
+            st.download_button(etiqueta, archivo, f"{nombre_base}.{extension}", mime, key=key)
+
 # ══════════════════════════════════════════════════════════════════════════════
 # PANEL: VISUALIZACIÓN
 # ══════════════════════════════════════════════════════════════════════════════
 
+TAMANOS_PAGINA = [25, 50, 100, 250]
+SIN_ORDEN      = "(orden de registro)"
+
+def _paginar(df, clave, tamanos=TAMANOS_PAGINA):
+    """
+    Controles de pagina y orden; retorna solo las filas de la pagina actual.
+    El orden y el corte se hacen en el servidor.
+    """
+    c1, c2, c3, c4 = st.columns([1, 2, 1, 1])
+    with c1:
+        tamano = st.selectbox("Filas por pagina", tamanos, key=f"{clave}_tamano")
+    with c2:
+        orden = st.selectbox("Ordenar por", [SIN_ORDEN] + list(df.columns), key=f"{clave}_orden")
+    with c3:
+        descendente = st.toggle("Descendente", key=f"{clave}_desc")
+    paginas = max(1, -(-len(df) // tamano))
+    if st.session_state.get(f"{clave}_pagina", 1) > paginas:
+        st.session_state[f"{clave}_pagina"] = paginas   # los filtros redujeron el resultado
+    with c4:
+        # Sin max_value: si cambiara con los filtros, Streamlit reiniciaria el widget
+        pagina = min(st.number_input("Pagina", min_value=1, step=1, key=f"{clave}_pagina"), paginas)
+    inicio = (pagina - 1) * tamano
+    if orden == SIN_ORDEN:
+        posiciones = np.arange(len(df))[::-1] if descendente else np.arange(len(df))
+    else:
+        # Solo se ordena la columna elegida; las filas se toman por posicion
+        posiciones = (df[orden].reset_index(drop=True)
+                      .sort_values(ascending=not descendente, kind="stable", na_position="last")
+                      .index.to_numpy())
+    st.caption(f"Filas {min(inicio + 1, len(df))}–{min(inicio + tamano, len(df))} de {len(df)} · "
+               f"pagina {pagina} de {paginas}")
+    return df.take(posiciones[inicio:inicio + tamano])
+
+def _tabla_paginada(df, clave):
+    """Muestra una pagina de df; al navegador solo viaja la pagina actual."""
+    st.dataframe(_paginar(df, clave), use_container_width=True, hide_index=True)
+
+def _vista_casos_hechos(df, df_h, union, clave):
+    """
+    Casos de la pagina actual, cada uno con sus hechos desplegables. Los
+    hechos se toman por posicion desde el indice ID_Caso -> filas, sin merge.
+    """
+    if df.empty or "ID_Caso" not in df.columns:
+        st.info("📭 No hay casos registrados")
+        return
+    for _, caso in _paginar(df, clave, tamanos=[10, 25, 50]).iterrows():
+        # El indice puede ir por delante del DataFrame si llegaron hechos nuevos
+        posiciones = [p for p in union.get(_clave_caso(caso["ID_Caso"]), ()) if p < len(df_h)]
+        with st.expander(f"{caso.get('OT-TE', '')} · Caso {caso['ID_Caso']} · "
+                         f"{caso.get('Departamento', '')} — {len(posiciones)} hecho(s)"):
+            if posiciones:
+                st.dataframe(df_h.take(posiciones), use_container_width=True, hide_index=True)
+            else:
+                st.caption("Sin hechos registrados para este caso")
+
 def panel_visualizacion():
     st.title("📊 Casos Registrados")
     st.markdown("---")
+    try:
+        tablas, filtros, resumenes, uniones, leida, revisiones = _tablas_panel(_version_datos().valor)
+        sheet_url = _get_spreadsheet().url
+    except Exception as e:
+        st.error(f"No se pudo conectar a Google Sheets: {e}")
+        return
+    if leida:
+        st.caption(f"🔄 Datos sincronizados a las {leida:%H:%M:%S}")
     tab_ind, tab_col = st.tabs(["👤 Individual", "👥 Colectivo"])
 
     # Tab Individual
     with tab_ind:
-        hoja_casos, hoja_hechos, sheet_url = conectar_sheets_individual()
-        if hoja_casos is None:
-            st.error("No se pudo conectar a la hoja Individual")
-        else:
-            if sheet_url:
-                st.markdown(f"[📝 Abrir en Google Sheets]({sheet_url})")
-            sub1, sub2 = st.tabs(["📋 Casos", "⚠️ Hechos de Riesgo"])
+        if sheet_url:
+            st.markdown(f"[📝 Abrir en Google Sheets]({sheet_url})")
+        sub1, sub2, sub3 = st.tabs(["📋 Casos", "⚠️ Hechos de Riesgo", "🔗 Casos y hechos"])
 
-            with sub1:
-                try:
-                    datos = _leer_con_retry(hoja_casos)
-                    if datos:
-                        df = pd.DataFrame(datos)
-                        c1, c2, c3, c4 = st.columns(4)
-                        c1.metric("Total Casos",   len(df))
-                        c2.metric("Departamentos", df["Departamento"].nunique()  if "Departamento"  in df.columns else 0)
-                        c3.metric("Municipios",    df["Municipio"].nunique()     if "Municipio"     in df.columns else 0)
-                        c4.metric("Riesgo Alto",   df["Nivel de Riesgo"].isin(["EXTREMO","EXTRAORDINARIO"]).sum() if "Nivel de Riesgo" in df.columns else 0)
-                        col1, col2, col3 = st.columns(3)
-                        with col1:
-                            depto = st.selectbox("Departamento", ["Todos"] + sorted(df["Departamento"].unique().tolist()) if "Departamento" in df.columns else ["Todos"], key="vi_ind_depto")
-                        with col2:
-                            riesgo = st.selectbox("Nivel de Riesgo", ["Todos"] + sorted(df["Nivel de Riesgo"].unique().tolist()) if "Nivel de Riesgo" in df.columns else ["Todos"], key="vi_ind_riesgo")
-                        with col3:
-                            analista_f = st.selectbox("Analista", ["Todos"] + sorted(df["Analista"].unique().tolist()) if "Analista" in df.columns else ["Todos"], key="vi_ind_analista")
-                        df_f = df.copy()
-                        if depto      != "Todos" and "Departamento"    in df.columns: df_f = df_f[df_f["Departamento"]    == depto]
-                        if riesgo     != "Todos" and "Nivel de Riesgo" in df.columns: df_f = df_f[df_f["Nivel de Riesgo"] == riesgo]
-                        if analista_f != "Todos" and "Analista"        in df.columns: df_f = df_f[df_f["Analista"]        == analista_f]
-                        st.subheader(f"📋 Resultados ({len(df_f)} casos)")
-                        st.dataframe(df_f, use_container_width=True, hide_index=True)
-                        csv = df_f.to_csv(index=False, encoding="utf-8-sig")
-                        st.download_button("📥 Descargar CSV", csv,
-                                           f"casos_individual_{datetime.now().strftime('%Y%m%d')}.csv",
-                                           "text/csv", key="dl_casos_ind")
-                    else:
-                        st.info("📭 No hay casos individuales registrados")
-                except Exception as e:
-                    st.error(f"Error al cargar casos individuales: {e}")
+        with sub1:
+            try:
+                df, ag = tablas["Individual"], resumenes["Individual"]
+                if not df.empty:
+                    c1, c2, c3, c4 = st.columns(4)
+                    c1.metric("Total Casos",   ag["total"])
+                    c2.metric("Departamentos", ag["distintos"].get("Departamento", 0))
+                    c3.metric("Municipios",    ag["distintos"].get("Municipio", 0))
+                    c4.metric("Riesgo Alto",   sum(ag["conteos"].get("Nivel de Riesgo", {}).get(n, 0) for n in NIVELES_RIESGO_ALTO))
+                    col1, col2, col3 = st.columns(3)
+                    with col1:
+                        depto = st.selectbox("Departamento", ag["opciones"].get("Departamento", ["Todos"]), key="vi_ind_depto")
+                    with col2:
+                        riesgo = st.selectbox("Nivel de Riesgo", ag["opciones"].get("Nivel de Riesgo", ["Todos"]), key="vi_ind_riesgo")
+                    with col3:
+                        analista_f = st.selectbox("Analista", ag["opciones"].get("Analista", ["Todos"]), key="vi_ind_analista")
+                    df_f = _filtrar(df, filtros["Individual"],
+                                    {"Departamento": depto, "Nivel de Riesgo": riesgo, "Analista": analista_f})
+                    st.subheader(f"📋 Resultados ({len(df_f)} casos)")
+                    _tabla_paginada(df_f, "pg_casos_ind")
+                    _descarga_diferida(df_f, "📥 Descargar casos",
+                                       f"casos_individual_{datetime.now().strftime('%Y%m%d')}", key="dl_casos_ind",
+                                       firma=(revisiones["Individual"], depto, riesgo, analista_f))
+                    _descarga_diferida(df_f, "📥 Descargar casos con hechos",
+                                       f"casos_individual_con_hechos_{datetime.now().strftime('%Y%m%d')}",
+                                       key="dl_casos_ind_unido", hechos=tablas["Hechos_Individual"],
+                                       firma=(revisiones["Individual"], revisiones["Hechos_Individual"],
+                                              depto, riesgo, analista_f))
+                else:
+                    st.info("📭 No hay casos individuales registrados")
+            except Exception as e:
+                st.error(f"Error al cargar casos individuales: {e}")
 
-            with sub2:
-                try:
-                    datos_h = _leer_con_retry(hoja_hechos)
-                    if datos_h:
-                        df_h = pd.DataFrame(datos_h)
-                        c1, c2, c3 = st.columns(3)
-                        c1.metric("Total Hechos",    len(df_h))
-                        c2.metric("Tipos distintos",  df_h["Tipo de Hecho"].nunique() if "Tipo de Hecho" in df_h.columns else 0)
-                        c3.metric("Casos con hechos", df_h["ID_Caso"].nunique()       if "ID_Caso"       in df_h.columns else 0)
-                        tipo_f = st.selectbox("Filtrar por Tipo", ["Todos"] + sorted(df_h["Tipo de Hecho"].unique().tolist()) if "Tipo de Hecho" in df_h.columns else ["Todos"], key="vi_ind_tipo_hecho")
-                        df_hf  = df_h[df_h["Tipo de Hecho"] == tipo_f].copy() if tipo_f != "Todos" else df_h.copy()
-                        st.dataframe(df_hf, use_container_width=True, hide_index=True)
-                        csv_h = df_hf.to_csv(index=False, encoding="utf-8-sig")
-                        st.download_button("📥 Descargar CSV Hechos", csv_h,
-                                           f"hechos_individual_{datetime.now().strftime('%Y%m%d')}.csv",
-                                           "text/csv", key="dl_hechos_ind")
-                    else:
-                        st.info("📭 No hay hechos individuales registrados")
-                except Exception as e:
-                    st.error(f"Error al cargar hechos individuales: {e}")
+        with sub2:
+            try:
+                df_h, ag_h = tablas["Hechos_Individual"], resumenes["Hechos_Individual"]
+                if not df_h.empty:
+                    c1, c2, c3 = st.columns(3)
+                    c1.metric("Total Hechos",    ag_h["total"])
+                    c2.metric("Tipos distintos",  ag_h["distintos"].get("Tipo de Hecho", 0))
+                    c3.metric("Casos con hechos", ag_h["distintos"].get("ID_Caso", 0))
+                    tipo_f = st.selectbox("Filtrar por Tipo", ag_h["opciones"].get("Tipo de Hecho", ["Todos"]), key="vi_ind_tipo_hecho")
+                    df_hf  = _filtrar(df_h, filtros["Hechos_Individual"], {"Tipo de Hecho": tipo_f})
+                    _tabla_paginada(df_hf, "pg_hechos_ind")
+                    _descarga_diferida(df_hf, "📥 Descargar hechos",
+                                       f"hechos_individual_{datetime.now().strftime('%Y%m%d')}", key="dl_hechos_ind",
+                                       firma=(revisiones["Hechos_Individual"], tipo_f))
+                else:
+                    st.info("📭 No hay hechos individuales registrados")
+            except Exception as e:
+                st.error(f"Error al cargar hechos individuales: {e}")
+
+        with sub3:
+            try:
+                _vista_casos_hechos(tablas["Individual"], tablas["Hechos_Individual"], uniones["Hechos_Individual"],
+                                    "pg_union_ind")
+            except Exception as e:
+                st.error(f"Error al cargar casos y hechos individuales: {e}")
 
     # Tab Colectivo
     with tab_col:
-        hoja_casos, hoja_hechos, sheet_url = conectar_sheets_colectivo()
-        if hoja_casos is None:
-            st.error("No se pudo conectar a la hoja Colectivo")
-        else:
-            if sheet_url:
-                st.markdown(f"[📝 Abrir en Google Sheets]({sheet_url})")
-            sub1, sub2 = st.tabs(["📋 Casos", "⚠️ Hechos de Riesgo"])
+        if sheet_url:
+            st.markdown(f"[📝 Abrir en Google Sheets]({sheet_url})")
+        sub1, sub2, sub3 = st.tabs(["📋 Casos", "⚠️ Hechos de Riesgo", "🔗 Casos y hechos"])
 
-            with sub1:
-                try:
-                    datos = _leer_con_retry(hoja_casos)
-                    if datos:
-                        df = pd.DataFrame(datos)
-                        c1, c2, c3, c4 = st.columns(4)
-                        c1.metric("Total Colectivos", len(df))
-                        c2.metric("Departamentos",    df["Departamento"].nunique() if "Departamento" in df.columns else 0)
-                        c3.metric("Municipios",       df["Municipio"].nunique()    if "Municipio"    in df.columns else 0)
-                        c4.metric("Sectores",         df["Sector"].nunique()       if "Sector"       in df.columns else 0)
-                        col1, col2, col3 = st.columns(3)
-                        with col1:
-                            depto = st.selectbox("Departamento", ["Todos"] + sorted(df["Departamento"].unique().tolist()) if "Departamento" in df.columns else ["Todos"], key="vi_col_depto")
-                        with col2:
-                            sector_f = st.selectbox("Sector", ["Todos"] + sorted(df["Sector"].unique().tolist()) if "Sector" in df.columns else ["Todos"], key="vi_col_sector")
-                        with col3:
-                            analista_f = st.selectbox("Analista", ["Todos"] + sorted(df["Analista"].unique().tolist()) if "Analista" in df.columns else ["Todos"], key="vi_col_analista")
-                        df_f = df.copy()
-                        if depto      != "Todos" and "Departamento" in df.columns: df_f = df_f[df_f["Departamento"] == depto]
-                        if sector_f   != "Todos" and "Sector"       in df.columns: df_f = df_f[df_f["Sector"]       == sector_f]
-                        if analista_f != "Todos" and "Analista"     in df.columns: df_f = df_f[df_f["Analista"]     == analista_f]
-                        st.subheader(f"📋 Resultados ({len(df_f)} colectivos)")
-                        st.dataframe(df_f, use_container_width=True, hide_index=True)
-                        csv = df_f.to_csv(index=False, encoding="utf-8-sig")
-                        st.download_button("📥 Descargar CSV", csv,
-                                           f"casos_colectivo_{datetime.now().strftime('%Y%m%d')}.csv",
-                                           "text/csv", key="dl_casos_col")
-                    else:
-                        st.info("📭 No hay casos colectivos registrados")
-                except Exception as e:
-                    st.error(f"Error al cargar casos colectivos: {e}")
+        with sub1:
+            try:
+                df, ag = tablas["Colectivo"], resumenes["Colectivo"]
+                if not df.empty:
+                    c1, c2, c3, c4 = st.columns(4)
+                    c1.metric("Total Colectivos", ag["total"])
+                    c2.metric("Departamentos",    ag["distintos"].get("Departamento", 0))
+                    c3.metric("Municipios",       ag["distintos"].get("Municipio", 0))
+                    c4.metric("Sectores",         ag["distintos"].get("Sector", 0))
+                    col1, col2, col3 = st.columns(3)
+                    with col1:
+                        depto = st.selectbox("Departamento", ag["opciones"].get("Departamento", ["Todos"]), key="vi_col_depto")
+                    with col2:
+                        sector_f = st.selectbox("Sector", ag["opciones"].get("Sector", ["Todos"]), key="vi_col_sector")
+                    with col3:
+                        analista_f = st.selectbox("Analista", ag["opciones"].get("Analista", ["Todos"]), key="vi_col_analista")
+                    df_f = _filtrar(df, filtros["Colectivo"],
+                                    {"Departamento": depto, "Sector": sector_f, "Analista": analista_f})
+                    st.subheader(f"📋 Resultados ({len(df_f)} colectivos)")
+                    _tabla_paginada(df_f, "pg_casos_col")
+                    _descarga_diferida(df_f, "📥 Descargar casos",
+                                       f"casos_colectivo_{datetime.now().strftime('%Y%m%d')}", key="dl_casos_col",
+                                       firma=(revisiones["Colectivo"], depto, sector_f, analista_f))
+                    _descarga_diferida(df_f, "📥 Descargar casos con hechos",
+                                       f"casos_colectivo_con_hechos_{datetime.now().strftime('%Y%m%d')}",
+                                       key="dl_casos_col_unido", hechos=tablas["Hechos_Colectivo"],
+                                       firma=(revisiones["Colectivo"], revisiones["Hechos_Colectivo"],
+                                              depto, sector_f, analista_f))
+                else:
+                    st.info("📭 No hay casos colectivos registrados")
+            except Exception as e:
+                st.error(f"Error al cargar casos colectivos: {e}")
+
+        with sub2:
+            try:
+                df_h, ag_h = tablas["Hechos_Colectivo"], resumenes["Hechos_Colectivo"]
+                if not df_h.empty:
+                    c1, c2, c3 = st.columns(3)
+                    c1.metric("Total Hechos",    ag_h["total"])
+                    c2.metric("Tipos distintos",  ag_h["distintos"].get("Tipo de Hecho", 0))
+                    c3.metric("Casos con hechos", ag_h["distintos"].get("ID_Caso", 0))
+                    tipo_f = st.selectbox("Filtrar por Tipo", ag_h["opciones"].get("Tipo de Hecho", ["Todos"]), key="vi_col_tipo_hecho")
+                    df_hf  = _filtrar(df_h, filtros["Hechos_Colectivo"], {"Tipo de Hecho": tipo_f})
+                    _tabla_paginada(df_hf, "pg_hechos_col")
+                    _descarga_diferida(df_hf, "📥 Descargar hechos",
+                                       f"hechos_colectivo_{datetime.now().strftime('%Y%m%d')}", key="dl_hechos_col",
+                                       firma=(revisiones["Hechos_Colectivo"], tipo_f))
+                else:
+                    st.info("📭 No hay hechos colectivos registrados")
+            except Exception as e:
+                st.error(f"Error al cargar hechos colectivos: {e}")
+
+        with sub3:
+            try:
+                _vista_casos_hechos(tablas["Colectivo"], tablas["Hechos_Colectivo"], uniones["Hechos_Colectivo"],
+                                    "pg_union_col")
+            except Exception as e:
+                st.error(f"Error al cargar casos y hechos colectivos: {e}")
+
+    mostrar_traza_rerun()
 
-            with sub2:
+
+# ══════════════════════════════════════════════════════════════════════════════
+# PANEL: IMPORTACIÓN MASIVA
+# ══════════════════════════════════════════════════════════════════════════════
+
+IMPORTACION_LOTE = 100   # casos por par de append_rows
+
+# tipo -> (hoja de casos, hoja de hechos, columnas que el archivo debe traer)
+IMPORTACION_TIPOS = {
+    "Individual": ("Individual", "Hechos_Individual",
+                   ["OT-TE", "Edad", "Sexo", "Departamento", "Municipio", "Solicitante",
+                    "Nivel de Riesgo", "Tipo de Estudio", "Año OT", "Mes OT"]),
+    "Colectivo":  ("Colectivo", "Hechos_Colectivo",
+                   ["OT-TE", "Nombre Colectivo", "Fecha Creacion Colectivo", "Sector",
+                    "Departamento", "Municipio"]),
+}
+COLUMNAS_HECHOS_IMPORTACION = ["OT-TE", "Tipo de Hecho", "Fecha del Hecho", "Lugar", "Autor", "Descripcion"]
+
+def _leer_archivo_importacion(archivo):
+    """CSV o XLSX subido, todo como texto y sin NaN."""
+    if archivo.name.lower().endswith(".xlsx"):
+        df = pd.read_excel(archivo, dtype=str)
+    else:
+        df = pd.read_csv(archivo, dtype=str, keep_default_na=False, encoding="utf-8-sig")
+    df = df.fillna("")
+    df.columns = [str(c).strip() for c in df.columns]
+    return df.apply(lambda col: col.str.strip())
+
+def _reglas_importacion(tipo, df, ots_existentes):
+    """Chequeos que dependen del contexto: OT-TE ya registrado o repetido en el archivo."""
+    ot = _texto(df["OT-TE"])
+    return [
+        (ot.isin(ots_existentes) & (ot != ""),         f"El caso ya existe en la hoja {tipo}"),
+        (ot.duplicated(keep="first") & (ot != ""),     "OT-TE repetido en el archivo"),
+    ]
+
+def _normalizar_importacion(df):
+    """Filas ya validadas con los mismos tipos que escriben los formularios."""
+    df = df.copy()
+    for col in ("Edad", "Año OT", "Mes OT"):
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col]).astype(int)
+    for col in ("Fecha Creacion Colectivo", "Fecha del Hecho"):
+        if col in df.columns:
+            df[col] = _fechas(df[col]).dt.strftime("%Y-%m-%d")
+    return df
+
+def _validar_importacion(tipo, casos, hechos):
+    """
+    Valida ambos archivos de una vez. Retorna (casos_validos, hechos_validos,
+    rechazos); los rechazos conservan la fila original, su numero en el
+    archivo y los errores encontrados.
+    """
+    hoja_casos, _, columnas = IMPORTACION_TIPOS[tipo]
+    faltantes = [c for c in columnas if c not in casos.columns]
+    if hechos is not None:
+        faltantes += [f"{c} (hechos)" for c in COLUMNAS_HECHOS_IMPORTACION if c not in hechos.columns]
+    if faltantes:
+        raise ValueError(f"Faltan columnas: {', '.join(faltantes)}")
+
+    casos = casos.assign(_archivo="casos", _fila=casos.index + 2)
+    casos["Errores"] = VALIDADORES[tipo].tabla(
+        casos, extra=_reglas_importacion(tipo, casos, _indice(_hoja(hoja_casos)).ots()))
+    validos   = _normalizar_importacion(casos[casos["Errores"] == ""])
+    rechazos  = [casos[casos["Errores"] != ""]]
+    if hechos is None:
+        hechos_validos = pd.DataFrame(columns=COLUMNAS_HECHOS_IMPORTACION)
+    else:
+        hechos = hechos.assign(_archivo="hechos", _fila=hechos.index + 2)
+        hechos["Errores"] = VALIDADORES["Hecho"].tabla(
+            hechos, extra=[(~hechos["OT-TE"].isin(validos["OT-TE"]), "El OT-TE no corresponde a un caso valido del archivo")])
+        hechos_validos = _normalizar_importacion(hechos[hechos["Errores"] == ""])
+        rechazos.append(hechos[hechos["Errores"] != ""])
+    rechazos = pd.concat(rechazos, ignore_index=True).rename(columns={"_archivo": "Archivo", "_fila": "Fila"})
+    return validos, hechos_validos, rechazos
+
+def _importar(tipo, casos, hechos, progreso):
+    """
+    Escribe los casos validos en lotes de IMPORTACION_LOTE (un append_rows
+    por hoja y lote) con la prioridad mas baja del planificador, para no
+    quitar cuota a los registros interactivos. Retorna (escritos,
+    descartados por OT-TE ya registrado, error); si un lote falla se detiene
+    y lo pendiente queda sin escribir.
+    """
+    nombre_casos, nombre_hechos, _ = IMPORTACION_TIPOS[tipo]
+    hoja_c, hoja_h = _hoja(nombre_casos), _hoja(nombre_hechos)
+    enc_c,  enc_h  = _asegurar_esquema(hoja_c), _asegurar_esquema(hoja_h)
+    indice_c, indice_h = _indice(hoja_c), _indice(hoja_h)
+    hechos_por_ot = {ot: grupo for ot, grupo in hechos.groupby("OT-TE")} if not hechos.empty else {}
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    escritos, descartados = 0, 0
+    try:
+        for inicio in range(0, len(casos), IMPORTACION_LOTE):
+            lote = casos.iloc[inicio:inicio + IMPORTACION_LOTE]
+            # Otra sesion pudo registrar alguno de estos OT-TE despues de validar
+            reclamados = [indice_c.reclamar_ot(ot) for ot in lote["OT-TE"]]
+            descartados += reclamados.count(False)
+            lote = lote[reclamados]
+            if lote.empty:
+                continue
+            # Cualquier fallo antes de escribir (reservar IDs, armar filas), al
+            # escribir o una recarga que corta el script (BaseException) suelta
+            # los OT-TE del lote, que pueden volver a importarse
+            try:
+                ids_caso = indice_c.reservar_ids(len(lote))
+                filas_c, filas_h = [], []
+                for id_caso, caso in zip(ids_caso, lote.to_dict("records")):
+                    registro = {col: caso.get(col, "") for col in ESQUEMAS[nombre_casos]}
+                    registro.update({
+                        "Timestamp": timestamp, "ID_Caso": id_caso, "ID_Solicitud": uuid.uuid4().hex,
+                        "Analista":         caso.get("Analista") or st.session_state.nombre_completo,
+                        "Usuario Analista": caso.get("Usuario Analista") or st.session_state.username,
+                    })
+                    filas_c.append(_alinear_fila(enc_c, registro))
+                    suyos = hechos_por_ot.get(caso["OT-TE"])
+                    if suyos is not None:
+                        ids_hecho = indice_h.reservar_ids(len(suyos))
+                        for id_hecho, hecho in zip(ids_hecho, suyos.to_dict("records")):
+                            filas_h.append(_alinear_fila(enc_h, {
+                                **{col: hecho.get(col, "") for col in COLUMNAS_HECHOS},
+                                "ID_Hecho": id_hecho, "ID_Caso": id_caso, "ID_Solicitud": registro["ID_Solicitud"],
+                                "Analista": registro["Analista"], "Usuario Analista": registro["Usuario Analista"],
+                            }))
                 try:
-                    datos_h = _leer_con_retry(hoja_hechos)
-                    if datos_h:
-                        df_h = pd.DataFrame(datos_h)
-                        c1, c2, c3 = st.columns(3)
-                        c1.metric("Total Hechos",    len(df_h))
-                        c2.metric("Tipos distintos",  df_h["Tipo de Hecho"].nunique() if "Tipo de Hecho" in df_h.columns else 0)
-                        c3.metric("Casos con hechos", df_h["ID_Caso"].nunique()       if "ID_Caso"       in df_h.columns else 0)
-                        tipo_f = st.selectbox("Filtrar por Tipo", ["Todos"] + sorted(df_h["Tipo de Hecho"].unique().tolist()) if "Tipo de Hecho" in df_h.columns else ["Todos"], key="vi_col_tipo_hecho")
-                        df_hf  = df_h[df_h["Tipo de Hecho"] == tipo_f].copy() if tipo_f != "Todos" else df_h.copy()
-                        st.dataframe(df_hf, use_container_width=True, hide_index=True)
-                        csv_h = df_hf.to_csv(index=False, encoding="utf-8-sig")
-                        st.download_button("📥 Descargar CSV Hechos", csv_h,
-                                           f"hechos_colectivo_{datetime.now().strftime('%Y%m%d')}.csv",
-                                           "text/csv", key="dl_hechos_col")
-                    else:
-                        st.info("📭 No hay hechos colectivos registrados")
+                    registrar_casos_con_hechos(hoja_c, hoja_h, filas_c, filas_h, prioridad=PRIORIDAD_PANEL)
                 except Exception as e:
-                    st.error(f"Error al cargar hechos colectivos: {e}")
+                    if _clasificar_error(e) != "transitorio":
+                        raise
+                    # El lote pudo quedar escrito: un reintento omite lo que ya esta
+                    registrar_casos_con_hechos(hoja_c, hoja_h, filas_c, filas_h,
+                                               prioridad=PRIORIDAD_PANEL, verificar=True)
+            except BaseException:
+                for ot in lote["OT-TE"]:
+                    indice_c.liberar_ot(ot)
+                raise
+            for ot in lote["OT-TE"]:
+                indice_c.confirmar_ot(ot)
+            perdidos = _descartar_duplicados(hoja_c, hoja_h, list(zip(lote["OT-TE"], ids_caso)))
+            escritos    += len(lote) - len(perdidos)
+            descartados += len(perdidos)
+            progreso.progress((escritos + descartados) / len(casos),
+                              text=f"{escritos} de {len(casos)} casos escritos")
+    except Exception as e:
+        return escritos, descartados, e
+    finally:
+        if escritos:
+            _version_datos().incrementar()
+    return escritos, descartados, None
+
+def panel_importacion():
+    st.title("📥 Importación Masiva")
+    st.markdown("---")
+    st.caption("Suba un archivo CSV o Excel con una fila por caso. Los hechos son opcionales "
+               "y se asocian al caso por la columna OT-TE.")
+    tipo = st.radio("Tipo de caso", list(IMPORTACION_TIPOS), horizontal=True, key="imp_tipo")
+    _, _, columnas = IMPORTACION_TIPOS[tipo]
+    st.caption(f"Columnas de casos: {', '.join(columnas)}")
+    st.caption(f"Columnas de hechos: {', '.join(COLUMNAS_HECHOS_IMPORTACION)}")
+    formatos = ["csv", "xlsx"] if importlib.util.find_spec("openpyxl") else ["csv"]
+    archivo_casos  = st.file_uploader("Archivo de casos", type=formatos, key="imp_casos")
+    archivo_hechos = st.file_uploader("Archivo de hechos (opcional)", type=formatos, key="imp_hechos")
+    if archivo_casos is None:
+        return
+    try:
+        casos  = _leer_archivo_importacion(archivo_casos)
+        hechos = _leer_archivo_importacion(archivo_hechos) if archivo_hechos is not None else None
+        validos, hechos_validos, rechazos = _validar_importacion(tipo, casos, hechos)
+    except Exception as e:
+        st.error(f"❌ No se pudo leer el archivo: {e}")
+        return
 
+    c1, c2, c3 = st.columns(3)
+    c1.metric("Casos válidos",  len(validos))
+    c2.metric("Hechos válidos", len(hechos_validos))
+    c3.metric("Filas rechazadas", len(rechazos))
+    if not rechazos.empty:
+        st.dataframe(rechazos[["Archivo", "Fila", "OT-TE", "Errores"]].head(200),
+                     use_container_width=True, hide_index=True)
+        st.download_button("📥 Descargar reporte de rechazos",
+                           rechazos.to_csv(index=False, encoding="utf-8-sig"),
+                           f"rechazos_{tipo.lower()}_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
+                           "text/csv", key="imp_rechazos")
+    if validos.empty:
+        st.info("📭 No hay casos válidos para importar")
+        return
+    if st.button(f"✅ Importar {len(validos)} caso(s) válidos", type="primary", key="imp_confirmar"):
+        progreso = st.progress(0.0, text="Escribiendo en Google Sheets...")
+        escritos, descartados, error = _importar(tipo, validos, hechos_validos, progreso)
+        if descartados:
+            st.warning(f"⚠️ {descartados} caso(s) omitidos: su OT-TE se registró mientras se importaba")
+        if error is None:
+            st.success(f"✅ {escritos} caso(s) importados en la hoja {tipo}")
+        else:
+            st.error(f"❌ Se importaron {escritos} de {len(validos)} casos; el resto no se escribió: {error}")
+
+# ══════════════════════════════════════════════════════════════════════════════
+# PANEL: RENDIMIENTO
+# ══════════════════════════════════════════════════════════════════════════════
+
+def panel_rendimiento():
+    st.title("⚡ Rendimiento")
+    st.markdown("---")
+    metricas = _metricas_api()
+    resumen  = metricas.resumen()
+    st.caption(f"Métricas de este proceso desde {resumen['desde']:%Y-%m-%d %H:%M:%S}")
+
+    recargas = resumen["por_recarga"]
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("Llamadas a la API", resumen["llamadas"])
+    c2.metric("Por recarga (media)", f"{recargas['media']:.1f}" if recargas else "—",
+              help=f"p95: {recargas['p95']:.0f}" if recargas else None)
+    c3.metric("Respuestas 429", resumen["por_resultado"]["429"])
+    c4.metric("Circuito", _circuito().estado())
+
+    st.subheader("⏱️ Latencia")
+    c1, c2, c3 = st.columns(3)
+    for col, p in zip((c1, c2, c3), ("p50", "p95", "p99")):
+        col.metric(p, f"{resumen['latencia'][p] * 1000:.0f} ms" if resumen["latencia"] else "—")
+
+    st.subheader("📶 Cuota estimada")
+    cuota = _planificador().estado()
+    limites = {"lectura": CUOTA_LECTURAS_MIN, "escritura": CUOTA_ESCRITURAS_MIN}
+    c1, c2 = st.columns(2)
+    for col, tipo in zip((c1, c2), ("lectura", "escritura")):
+        usadas = resumen["ultimo_minuto"][tipo]
+        col.metric(f"{tipo.capitalize()}: restantes este minuto", max(limites[tipo] - usadas, 0),
+                   help=f"{usadas} enviadas en los últimos 60 s · "
+                        f"{cuota[tipo]['tokens']} tokens en el planificador")
+
+    st.subheader("📋 Por función y hoja")
+    tabla = metricas.tabla()
+    if tabla.empty:
+        st.info("Aún no hay llamadas registradas")
+    else:
+        st.dataframe(tabla, use_container_width=True, hide_index=True)
+    st.download_button("📥 Exportar (Prometheus)", metricas.prometheus(),
+                       f"ismr_metricas_{datetime.now():%Y%m%d_%H%M%S}.prom", "text/plain")
+
+    st.subheader("🔬 Perfilado de recargas")
+    perfilador = _perfilador()
+    perfilador.activo = st.toggle(
+        "Perfilar cada recarga (todas las sesiones)", value=perfilador.activo,
+        help=f"Mide tiempo de CPU con cProfile y guarda los últimos {PERFILES_MAX} perfiles. "
+             "Hace más lenta cada recarga mientras está activo.")
+    perfiles = list(perfilador.perfiles)
+    if not perfiles:
+        st.info("No hay perfiles guardados")
+        return
+    st.dataframe(pd.DataFrame([
+        {"Hora": p["timestamp"], "Página": p["pagina"], "Usuario": p["usuario"],
+         "Total ms": round(p["segundos"] * 1000), "CPU ms": round(p["cpu"] * 1000)}
+        for p in reversed(perfiles)
+    ]), use_container_width=True, hide_index=True)
+    etiquetas = {f"{p['timestamp']} · {p['pagina']} · {p['usuario']}": p for p in reversed(perfiles)}
+    elegido = etiquetas[st.selectbox("Perfil", list(etiquetas))]
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button("📥 Pilas colapsadas (flamegraph)", elegido["pilas"],
+                           f"ismr_perfil_{elegido['pagina']}_{elegido['timestamp'][11:].replace(':', '')}.folded",
+                           "text/plain", use_container_width=True)
+    with col2:
+        # Mismo formato: flamegraph.pl y speedscope suman las pilas repetidas
+        st.download_button("📥 Todos los perfiles", "".join(p["pilas"] for p in perfiles),
+                           f"ismr_perfiles_{datetime.now():%Y%m%d_%H%M%S}.folded",
+                           "text/plain", use_container_width=True)
 
 # ══════════════════════════════════════════════════════════════════════════════
 # PANEL: GESTIÓN DE USUARIOS
@@ -1160,13 +3730,18 @@ def main():
     if st.session_state.es_admin:
         st.sidebar.title("📊 Sistema ISMR")
         st.sidebar.success(f"👤 {st.session_state.nombre_completo}")
+        mostrar_estado_cuota()
+        mostrar_estado_borradores()
+        mostrar_estado_cola()
         st.sidebar.markdown("---")
         opcion = st.sidebar.radio("Menú", [
             "🏠 Inicio",
             "👤 Individual",
             "👥 Colectivo",
             "📊 Ver Datos",
-            "👥 Gestionar Usuarios"
+            "📥 Importación Masiva",
+            "👥 Gestionar Usuarios",
+            "⚡ Rendimiento"
         ])
         if st.sidebar.button("🚪 Cerrar Sesión", use_container_width=True):
             logout()
@@ -1175,6 +3750,8 @@ def main():
         elif opcion == "👤 Individual":         formulario_individual()
         elif opcion == "👥 Colectivo":          formulario_colectivo()
         elif opcion == "📊 Ver Datos":          panel_visualizacion()
+        elif opcion == "📥 Importación Masiva": panel_importacion()
+        elif opcion == "⚡ Rendimiento":        panel_rendimiento()
         else:                                   panel_gestion_usuarios()
         return
 
@@ -1186,4 +3763,9 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    _iniciar_traza()
+    try:
+        with _perfilador().perfilar():
+            main()
+    finally:
+        _cerrar_traza()
@@ -0,0 +1,299 @@
+"""
+Simulacion de registros concurrentes contra un Google Sheets en memoria.
+
+Varias sesiones (AppTest de Streamlit) registran casos individuales por
+turnos; cada llamada a la API tarda --latencia segundos. Se mide el tiempo
+hasta encolar todo y hasta que la cola local queda sincronizada, y cuantas
+llamadas de cada metodo se hicieron.
+
+La app se copia a una carpeta temporal, asi la cola SQLite de la prueba no
+toca la real. Para comparar dos versiones se corre sobre cada una, p.ej.:
+
+    git show f989241^:app_ismr_sheets.py > /tmp/antes.py
+    python benchmarks/simular_registros.py --app /tmp/antes.py
+    python benchmarks/simular_registros.py
+
+Requiere las dependencias de requirements.txt; no usa credenciales.
+"""
+
+import argparse
+import collections
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import google.oauth2.service_account
+import gspread
+from streamlit.testing.v1 import AppTest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LLAMADAS = collections.Counter()
+LATENCIA = 0.0
+
+# ── Google Sheets en memoria ──────────────────────────────────────────────────
+
+def _columna(letras):
+    n = 0
+    for letra in letras:
+        n = n * 26 + ord(letra) - 64
+    return n
+
+def _rango(a1):
+    """(fila1, col1, fila2, col2) de un rango A1; sin limite si falta la fila o la columna."""
+    if "!" not in a1 and a1.startswith("'"):
+        return 1, 1, 10 ** 9, 10 ** 6
+    a1 = a1.split("!")[-1]
+    inicio, _, fin = a1.partition(":")
+    fin = fin or inicio
+    if inicio.isdigit():
+        return int(inicio), 1, int(fin), 10 ** 6
+    (l1, f1), (l2, f2) = (re.match(r"([A-Z]+)(\d*)", x).groups() for x in (inicio, fin))
+    return int(f1 or 1), _columna(l1), int(f2 or 10 ** 9), _columna(l2)
+
+def _llamada(metodo):
+    LLAMADAS[metodo] += 1
+    if LATENCIA:
+        time.sleep(LATENCIA)
+
+class HojaMemoria:
+    def __init__(self, libro, titulo):
+        self.spreadsheet, self.title, self.filas = libro, titulo, []
+        self.id, self.row_count, self.col_count = len(libro.hojas), 1000, 26
+
+    def _recortar(self):
+        while self.filas and not any(self.filas[-1]):
+            self.filas.pop()
+
+    def _poner(self, fila, col, valor):
+        while len(self.filas) < fila:
+            self.filas.append([])
+        celdas = self.filas[fila - 1]
+        celdas.extend([""] * (col - len(celdas)))
+        celdas[col - 1] = "" if valor is None else str(valor)
+
+    def _cortar(self, f1, c1, f2, c2):
+        self._recortar()
+        salida = []
+        for fila in self.filas[f1 - 1:min(f2, len(self.filas))]:
+            celdas = fila[c1 - 1:c2]
+            while celdas and celdas[-1] == "":
+                celdas = celdas[:-1]
+            salida.append(list(celdas))
+        while salida and not salida[-1]:
+            salida.pop()
+        return salida
+
+    def get_all_values(self, **_):
+        _llamada("get_all_values")
+        self._recortar()
+        ancho = max((len(f) for f in self.filas), default=0)
+        return [f + [""] * (ancho - len(f)) for f in self.filas]
+
+    def get(self, a1, **_):
+        _llamada("get")
+        return self._cortar(*_rango(a1))
+
+    def row_values(self, n, **_):
+        _llamada("row_values")
+        self._recortar()
+        return list(self.filas[n - 1]) if n <= len(self.filas) else []
+
+    def append_row(self, valores, **kwargs):
+        return self.append_rows([valores], **kwargs)
+
+    def append_rows(self, valores, **_):
+        _llamada("append_rows")
+        self._recortar()
+        inicio = len(self.filas) + 1
+        for i, fila in enumerate(valores):
+            for j, valor in enumerate(fila):
+                self._poner(inicio + i, j + 1, valor)
+        fin = inicio + len(valores) - 1
+        return {"updates": {"updatedRange": f"'{self.title}'!A{inicio}:Z{fin}", "updatedRows": len(valores)}}
+
+    def update(self, a1, valores=None, **_):
+        _llamada("update")
+        f1, c1, _, _ = _rango(a1)
+        for i, fila in enumerate(valores):
+            for j, valor in enumerate(fila):
+                self._poner(f1 + i, c1 + j, valor)
+        return {}
+
+    def batch_update(self, datos, **_):
+        _llamada("batch_update")
+        for d in datos:
+            f1, c1, _, _ = _rango(d["range"])
+            for i, fila in enumerate(d["values"]):
+                for j, valor in enumerate(fila):
+                    self._poner(f1 + i, c1 + j, valor)
+
+    def batch_clear(self, rangos):
+        _llamada("batch_clear")
+        for a1 in rangos:
+            f1, c1, f2, c2 = _rango(a1)
+            for fila in self.filas[f1 - 1:f2]:
+                for c in range(c1, min(c2, len(fila)) + 1):
+                    fila[c - 1] = ""
+
+    def delete_rows(self, inicio, fin=None):
+        _llamada("delete_rows")
+        del self.filas[inicio - 1:fin or inicio]
+
+    def add_cols(self, n):
+        _llamada("add_cols")
+
+class LibroMemoria:
+    def __init__(self, titulo):
+        self.title, self.id, self.url, self.hojas = titulo, titulo, f"memoria://{titulo}", {}
+
+    def add_worksheet(self, title, rows, cols, index=None):
+        _llamada("add_worksheet")
+        self.hojas[title] = HojaMemoria(self, title)
+        return self.hojas[title]
+
+    def worksheet(self, titulo):
+        _llamada("worksheet")
+        if titulo not in self.hojas:
+            raise gspread.exceptions.WorksheetNotFound(titulo)
+        return self.hojas[titulo]
+
+    def worksheets(self):
+        _llamada("worksheets")
+        return list(self.hojas.values())
+
+    def get_worksheet(self, indice):
+        _llamada("get_worksheet")
+        if not self.hojas:
+            self.add_worksheet("Hoja1", 1, 1)
+        return list(self.hojas.values())[indice]
+
+    @property
+    def sheet1(self):
+        return self.get_worksheet(0)
+
+    def values_batch_get(self, rangos, params=None):
+        _llamada("values_batch_get")
+        return {"valueRanges": [{"range": a1, "values": self.hojas[a1.split("!")[0].strip("'")]._cortar(*_rango(a1))}
+                                for a1 in rangos]}
+
+    def share(self, *args, **kwargs):
+        pass
+
+class ClienteMemoria:
+    def __init__(self):
+        self.libros  = {}
+        self.session = type("Sesion", (), {"mount": lambda self, *args: None})()
+
+    def open(self, nombre):
+        _llamada("open")
+        if nombre not in self.libros:
+            raise gspread.exceptions.SpreadsheetNotFound(nombre)
+        return self.libros[nombre]
+
+    def create(self, nombre):
+        self.libros[nombre] = LibroMemoria(nombre)
+        return self.libros[nombre]
+
+# ── Datos y sesiones ──────────────────────────────────────────────────────────
+
+ENCABEZADOS_INDIVIDUAL = ["Timestamp", "OT-TE", "Edad", "Sexo", "Departamento", "Municipio", "Solicitante",
+                          "Nivel de Riesgo", "Observaciones", "Analista", "Usuario Analista", "ID_Caso",
+                          "Tipo de Estudio", "Año OT", "Mes OT"]
+ENCABEZADOS_HECHOS = ["ID_Hecho", "ID_Caso", "OT-TE", "Tipo de Hecho", "Fecha del Hecho", "Lugar", "Autor",
+                      "Descripcion", "Analista", "Usuario Analista"]
+
+def sembrar(cliente, casos):
+    libro = cliente.create("ISMR_Casos")
+    libro.add_worksheet("Individual", 1, 1).filas = [list(ENCABEZADOS_INDIVIDUAL)] + [
+        ["2024-01-01", f"OT-{i}", "30", "Hombre", "Cauca", "M", "ARN", "EXTREMO", "", "Ana", "ana", str(i),
+         "ORDEN DE TRABAJO OT", "2024", "1"] for i in range(1, casos + 1)]
+    libro.add_worksheet("Hechos_Individual", 1, 1).filas = [list(ENCABEZADOS_HECHOS)]
+    clave = hashlib.sha256(b"x").hexdigest()
+    cliente.create("ISMR_Usuarios").add_worksheet("Usuarios", 1, 1).filas = [
+        ["username", "password_hash", "nombre_completo", "es_admin", "debe_cambiar_password"],
+        ["ana", clave, "Ana Perez", "FALSE", "FALSE"],
+        ["beto", clave, "Beto Diaz", "FALSE", "FALSE"],
+        ["carla", clave, "Carla Ruiz", "FALSE", "FALSE"]]
+
+def abrir_sesion(app, usuario):
+    at = AppTest.from_file(app, default_timeout=120)
+    at.secrets["gcp_service_account"] = {"client_email": "simulacion@memoria"}
+    at.run()
+    at.text_input[0].input(usuario)
+    at.text_input[1].input("x")
+    at.button[0].click()
+    at.run()
+    [b for b in at.button if b.key == "btn_individual"][0].click()
+    at.run()
+    return at
+
+def registrar(at, ot_te):
+    at.text_input(key="ind_ot").input(ot_te)
+    at.number_input(key="ind_edad").set_value(33)
+    at.selectbox(key="ind_sexo").set_value("Mujer")
+    at.text_input(key="ind_depto").input("Meta")
+    at.text_input(key="ind_muni").input("Villavicencio")
+    at.number_input(key="ind_anio").set_value(2024)
+    at.number_input(key="ind_mes").set_value(3)
+    at.selectbox(key="ind_sol").set_value("ARN")
+    at.selectbox(key="ind_tipo_estudio").set_value("ORDEN DE TRABAJO OT")
+    at.selectbox(key="ind_riesgo").set_value("EXTREMO")
+    at.session_state["hechos_individual"] = [
+        {"tipo": "Amenaza", "fecha": "2024-01-01", "lugar": "L", "autor": "A", "descripcion": "D"}]
+    [b for b in at.button if "REGISTRAR CASO INDIVIDUAL" in b.label][0].click()
+    at.run()
+
+def pendientes_en_cola(carpeta):
+    ruta = os.path.join(carpeta, "ismr_cola.db")
+    if not os.path.exists(ruta):
+        return 0   # version sin cola local: se escribe al registrar
+    with sqlite3.connect(ruta) as con:
+        return con.execute("SELECT COUNT(*) FROM registros"
+                           " WHERE estado IN ('pendiente', 'enviando', 'escrito')").fetchone()[0]
+
+def main():
+    global LATENCIA
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--app", default=os.path.join(RAIZ, "app_ismr_sheets.py"))
+    parser.add_argument("--latencia", type=float, default=0.05, help="segundos por llamada a la API")
+    parser.add_argument("--sesiones", type=int, default=3)
+    parser.add_argument("--rondas", type=int, default=10, help="registros por sesion")
+    parser.add_argument("--casos", type=int, default=2000, help="filas previas en la hoja Individual")
+    args = parser.parse_args()
+
+    cliente = ClienteMemoria()
+    sembrar(cliente, args.casos)
+    google.oauth2.service_account.Credentials.from_service_account_info = staticmethod(
+        lambda info, scopes=None: object())
+    gspread.authorize = lambda credenciales, **kwargs: cliente
+
+    carpeta = tempfile.mkdtemp(prefix="ismr_simulacion_")
+    app = shutil.copy(args.app, os.path.join(carpeta, "app_ismr_sheets.py"))
+    usuarios = ["ana", "beto", "carla"]
+    sesiones = [abrir_sesion(app, usuarios[i % len(usuarios)]) for i in range(args.sesiones)]
+
+    LATENCIA = args.latencia
+    LLAMADAS.clear()
+    inicio = time.time()
+    for ronda in range(args.rondas):
+        for i, at in enumerate(sesiones):
+            registrar(at, f"SIM-{ronda}-{i}")
+    encolado = time.time() - inicio
+    while pendientes_en_cola(carpeta):
+        time.sleep(0.05)
+    total = time.time() - inicio
+
+    escritos = sum(f[1].startswith("SIM-") for f in cliente.libros["ISMR_Casos"].hojas["Individual"].filas)
+    print(f"{args.sesiones * args.rondas} registros ({escritos} en la hoja) · latencia {LATENCIA * 1000:.0f} ms")
+    print(f"encolar: {encolado:.2f} s · hasta sincronizar: {total:.2f} s")
+    print("llamadas: " + ", ".join(f"{m} {n}" for m, n in sorted(LLAMADAS.items())))
+    shutil.rmtree(carpeta, ignore_errors=True)
+
+if __name__ == "__main__":
+    sys.exit(main())